@@ -0,0 +1,304 @@
+"""Benchmarks for the bot hot paths
+
+Usage:
+    python bench.py db [--users 10000] [--seconds 3]
+    python bench.py phase [--users 5000] [--interval 305]
+    python bench.py load [--users 10000] [--interval 60] [--seconds 120] [--latency 0.05] [--flood 0.001]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from telethon.crypto import AuthKey
+from telethon.errors import FloodWaitError, ChatWriteForbiddenError
+from telethon.sessions import StringSession
+from telethon.tl.types import InputPeerChannel
+from db import Database, AsyncDatabase
+from metrics import registry
+from mtproto import MTProtoManager, process_rss
+from ratelimit import TargetLimiter
+from scheduler import Scheduler, next_slot, send_jitter
+
+class PooledDatabase(Database):
+    """Database with persistent WAL connections but no user cache"""
+    
+    def get_record(self, user_id):
+        with self.get_conn() as conn:
+            return self._fetch_record(conn, user_id)
+
+class LegacyDatabase(PooledDatabase):
+    """Database with the old open/commit/close cycle per call and no user cache"""
+    
+    @contextmanager
+    def get_conn(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+class FakeClient:
+    """Offline TelegramClient stand-in with simulated latency and errors"""
+    rpc_latency = 0.05
+    connect_latency = 0.2
+    flood_rate = 0.0
+    ban_rate = 0.0
+    rnd = random.Random(1)
+    
+    def __init__(self, session, api_id, api_hash):
+        self.session = session
+        self.connected = False
+    
+    async def rpc(self, latency):
+        await asyncio.sleep(latency * self.rnd.uniform(0.5, 1.5))
+    
+    async def connect(self):
+        await self.rpc(self.connect_latency)
+        self.connected = True
+    
+    async def disconnect(self):
+        self.connected = False
+    
+    def is_connected(self):
+        return self.connected
+    
+    async def is_user_authorized(self):
+        await self.rpc(self.rpc_latency)
+        return True
+    
+    async def get_input_entity(self, chat_id):
+        await self.rpc(self.rpc_latency)
+        return InputPeerChannel(abs(chat_id), 1)
+    
+    async def get_dialogs(self):
+        return []
+    
+    async def send_message(self, peer, text, formatting_entities=None):
+        await self.rpc(self.rpc_latency)
+        roll = self.rnd.random()
+        if roll < self.flood_rate:
+            raise FloodWaitError(None, capture=self.rnd.randint(5, 60))
+        if roll < self.flood_rate + self.ban_rate:
+            raise ChatWriteForbiddenError(None)
+        return object()
+
+def fake_session():
+    """Valid StringSession that FakeClient never really connects with"""
+    session = StringSession()
+    session.set_dc(2, '149.154.167.51', 443)
+    session.auth_key = AuthKey(bytes(256))
+    return session.save()
+
+def fill_users(db, count, session_string='x' * 350):
+    """Insert test users with messages, half of them active"""
+    with db.get_conn() as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO users (user_id, phone, session_string) VALUES (?, ?, ?)',
+            ((uid, f'+99890{uid:07d}', session_string) for uid in range(1, count + 1))
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO messages (user_id, message_text) VALUES (?, ?)',
+            ((uid, f'Toshkent - Samarqand, 4 joy bor #{uid}') for uid in range(1, count + 1))
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO sending_state (user_id, is_active) VALUES (?, ?)',
+            ((uid, uid % 2) for uid in range(1, count + 1))
+        )
+    db.set_target_group(-1001234567890)
+    db.load_records()
+
+def tick(db, user_id):
+    """Queries of a single scheduler tick"""
+    db.is_sending_active(user_id)
+    db.get_user(user_id)
+    db.get_message(user_id)
+    db.get_target_group()
+    db.get_interval()
+    return 5
+
+def measure(db, users, seconds):
+    """Run scheduler ticks for random users, return queries per second"""
+    rnd = random.Random(1)
+    queries = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            queries += tick(db, rnd.randint(1, users))
+    return queries / (time.perf_counter() - start)
+
+def bench_db(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = LegacyDatabase(os.path.join(tmp, 'legacy.db'))
+        fill_users(legacy, args.users)
+        before = measure(legacy, args.users, args.seconds)
+        
+        pooled = PooledDatabase(os.path.join(tmp, 'pooled.db'))
+        fill_users(pooled, args.users)
+        reused = measure(pooled, args.users, args.seconds)
+        pooled.close()
+        
+        cached = Database(os.path.join(tmp, 'cached.db'))
+        fill_users(cached, args.users)
+        after = measure(cached, args.users, args.seconds)
+        cached.close()
+    
+    print(f"users: {args.users}")
+    print(f"open/close per call: {before:12.0f} q/s")
+    print(f"WAL conn:            {reused:12.0f} q/s ({reused / before:.1f}x)")
+    print(f"WAL conn + cache:    {after:12.0f} q/s ({after / before:.1f}x)")
+
+def rate_distribution(send_times, start, interval):
+    """Sends per second over one interval window"""
+    per_second = Counter(int(t - start) for t in send_times if start <= t < start + interval)
+    counts = [per_second.get(sec, 0) for sec in range(int(interval))]
+    return {
+        'mean': statistics.mean(counts),
+        'stdev': statistics.pstdev(counts),
+        'max': max(counts),
+        'idle': sum(1 for c in counts if c == 0),
+    }
+
+def bench_phase(args):
+    rnd = random.Random(1)
+    user_ids = [rnd.randint(10**8, 7 * 10**9) for _ in range(args.users)]
+    start = time.time()
+    
+    # Old behaviour: every restored sender fires at once and stays in lockstep
+    synced = [start for _ in user_ids]
+    spread = [next_slot(uid, args.interval, start) + send_jitter(args.interval) for uid in user_ids]
+    
+    print(f"users: {args.users}, interval: {args.interval}s")
+    print(f"{'':14}{'mean/s':>8}{'stdev':>8}{'max/s':>8}{'idle s':>8}")
+    for name, times in (('synchronized', synced), ('phase-spread', spread)):
+        d = rate_distribution(times, start, args.interval)
+        print(f"{name:14}{d['mean']:8.1f}{d['stdev']:8.1f}{d['max']:8d}{d['idle']:8d}")
+
+def percentiles(samples):
+    if not samples:
+        return '-'
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))] * 1000
+    return f"p50 {pick(0.5):.1f} ms, p99 {pick(0.99):.1f} ms, max {samples[-1] * 1000:.1f} ms"
+
+async def loop_lag(samples, step=0.05):
+    """Collect how late the event loop wakes up a sleeping task"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(step)
+        samples.append(loop.time() - start - step)
+
+def sends_by_outcome():
+    return {dict(labels)['outcome']: value for (name, labels), value in registry.counters.items() if name == 'sends_total'}
+
+def db_queries():
+    return sum(h.count for (name, _), h in registry.histograms.items() if name == 'db_query_seconds')
+
+async def run_load(args, tmp):
+    FakeClient.rpc_latency = args.latency
+    FakeClient.connect_latency = args.connect_latency
+    FakeClient.flood_rate = args.flood
+    FakeClient.ban_rate = args.ban
+    
+    rss_start = process_rss()
+    raw = Database(os.path.join(tmp, 'load.db'))
+    fill_users(raw, args.users, fake_session())
+    raw.set_sending_active_many(range(1, args.users + 1), True)
+    raw.set_interval(args.interval)
+    
+    db = AsyncDatabase(raw)
+    mgr = MTProtoManager(db, max_clients=args.users, client_cls=FakeClient)
+    # Local connects are cheap, the production warm-up rate would dominate the run
+    warm_up = mgr.warm_up
+    mgr.warm_up = lambda users: warm_up(users, concurrency=args.warmup_concurrency, rate=args.warmup_rate)
+    
+    scheduler = Scheduler(None, db, mgr)
+    scheduler.limiter = TargetLimiter(args.target_rate, args.target_rate)
+    
+    lateness = []
+    submit = scheduler.pool.submit
+    def timed_submit(user_id, due):
+        lateness.append(time.time() - due)
+        return submit(user_id, due)
+    scheduler.pool.submit = timed_submit
+    
+    lag = []
+    monitor = asyncio.create_task(loop_lag(lag))
+    sends_before, queries_before = sends_by_outcome(), db_queries()
+    
+    start = time.perf_counter()
+    await scheduler.restore_senders()
+    await scheduler.warmup
+    warmup_seconds = time.perf_counter() - start
+    rss_ready = process_rss()
+    
+    await asyncio.sleep(max(0, args.seconds - warmup_seconds))
+    elapsed = time.perf_counter() - start
+    
+    monitor.cancel()
+    scheduler.stop()
+    await scheduler.send_log.close()
+    await mgr.disconnect_all()
+    db.close()
+    
+    sends = {k: v - sends_before.get(k, 0) for k, v in sends_by_outcome().items()}
+    total = sum(sends.values())
+    pool = scheduler.pool.stats()
+    
+    print(f"users: {args.users}, interval: {args.interval}s, run: {elapsed:.0f}s, warm-up: {warmup_seconds:.1f}s")
+    print(f"sends:        {total} ({total / elapsed:.1f}/s, expected {args.users / args.interval:.1f}/s)")
+    print(f"outcomes:     {', '.join(f'{k} {v:g}' for k, v in sorted(sends.items())) or '-'}")
+    print(f"dropped:      {pool['full']} queue full, {pool['overdue']} overdue, {pool['busy']} still running")
+    print(f"tick late:    {percentiles(lateness)}")
+    print(f"loop lag:     {percentiles(lag)}")
+    print(f"db queries:   {(db_queries() - queries_before) / elapsed:.0f}/s on the executor")
+    print(f"memory:       {(rss_ready - rss_start) / args.users / 1024:.1f} KB per account")
+
+def bench_load(args):
+    # Injected FloodWait and ban errors would flood the output
+    logging.disable(logging.ERROR)
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run_load(args, tmp))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    
+    p = sub.add_parser('db', help='Database queries per second, before/after pooling')
+    p.add_argument('--users', type=int, default=10000)
+    p.add_argument('--seconds', type=float, default=3)
+    p.set_defaults(func=bench_db)
+    
+    p = sub.add_parser('phase', help='Sends per second distribution over one interval')
+    p.add_argument('--users', type=int, default=5000)
+    p.add_argument('--interval', type=int, default=305)
+    p.set_defaults(func=bench_phase)
+    
+    p = sub.add_parser('load', help='Scheduler, pool and database under load with a fake Telegram client')
+    p.add_argument('--users', type=int, default=10000)
+    p.add_argument('--interval', type=int, default=60)
+    p.add_argument('--seconds', type=float, default=120)
+    p.add_argument('--latency', type=float, default=0.05, help='RPC latency, seconds')
+    p.add_argument('--connect-latency', type=float, default=0.2)
+    p.add_argument('--flood', type=float, default=0.0, help='FloodWait probability per send')
+    p.add_argument('--ban', type=float, default=0.0, help='ban probability per send')
+    p.add_argument('--target-rate', type=float, default=1000, help='sends per second into the target group')
+    p.add_argument('--warmup-concurrency', type=int, default=200)
+    p.add_argument('--warmup-rate', type=float, default=2000)
+    p.set_defaults(func=bench_load)
+    
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
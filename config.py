@@ -9,6 +9,49 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
 
 DEFAULT_INTERVAL = 305  # 5 min 5 sek
+SEND_JITTER = 10  # random shift of each send, seconds
+TARGET_RATE = 1.0  # sends per second into one target group from all accounts
+TARGET_BURST = 5  # sends allowed at once before TARGET_RATE applies
+MAX_USER_TARGETS = 10  # own target groups per user
+TARGET_MAX_FAILURES = 5  # consecutive failures before a user's target is disabled
+ACCOUNT_FANOUT = 3  # targets one account posts to at the same time
+SEND_TIMEOUT = 60  # limit of a single send to one target, seconds
+SEND_WORKERS = 100  # sends running at the same time
+SEND_QUEUE_SIZE = 5000  # due sends waiting for a worker, later ticks are dropped
+SEND_MAX_LAG = 60  # queued ticks later than this are dropped, seconds
+SEND_LOG_BATCH = 500  # delivery log rows written in one transaction
+SEND_LOG_FLUSH = 5  # delivery log write delay, seconds
+SEND_LOG_DAYS = 30  # delivery log retention, days
+FLOOD_PACE_STEP = 1.5  # interval multiplier growth after each FloodWait
+FLOOD_PACE_MAX = 4  # largest interval multiplier of a flood-limited account
+FLOOD_PACE_DECAY = 0.9  # multiplier shrink after each successful send
 SESSION_DIR = 'sessions'
+MEDIA_DIR = 'media'
+BACKUP_DIR = 'backups'
 
-os.makedirs(SESSION_DIR, exist_ok=True)
\ No newline at end of file
+DB_CACHE_KB = 8192  # SQLite page cache per connection
+DB_STATEMENT_CACHE = 256  # prepared statements kept per connection
+USER_CACHE_SIZE = 0  # users kept in memory, 0 = all
+USERS_PAGE_SIZE = 30  # users per admin list page
+BACKUP_PAGES = 256  # pages copied per backup step, the read lock is held only during a step
+BACKUP_PAUSE = 0.005  # pause between backup steps, seconds
+BACKUP_MAX_RESTARTS = 10  # copies restarted by concurrent writes before finishing in one step
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', '0'))  # scheduled backups, seconds, 0 = off
+BACKUP_KEEP = 7  # backup files kept in BACKUP_DIR
+
+WARMUP_CONCURRENCY = 20  # sessions connecting at the same time on startup
+WARMUP_RATE = 10  # new connections per second on startup
+WARMUP_DEFER = 30  # delay of a send whose session is still warming up, seconds
+
+MAX_CLIENTS = 500  # live MTProto connections kept in the pool
+CLIENT_IDLE_TIMEOUT = 900  # disconnect clients unused for this long, seconds
+
+LOGIN_TTL = 600  # unfinished dialog state lifetime, seconds
+MAX_PENDING_LOGINS = 200  # dialog states kept at the same time
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # local Prometheus endpoint, 0 = off
+SHARDS = int(os.getenv('SHARDS', '0'))  # sender worker processes, 0 = send from the bot process
+
+os.makedirs(SESSION_DIR, exist_ok=True)
+os.makedirs(MEDIA_DIR, exist_ok=True)
+os.makedirs(BACKUP_DIR, exist_ok=True)
\ No newline at end of file
@@ -1,21 +1,157 @@
+import asyncio
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from config import DEFAULT_INTERVAL
+from functools import partial
+from itertools import islice
+from config import (
+    DEFAULT_INTERVAL, DB_CACHE_KB, DB_STATEMENT_CACHE, USER_CACHE_SIZE, USERS_PAGE_SIZE,
+    TARGET_MAX_FAILURES, BACKUP_PAGES, BACKUP_PAUSE, BACKUP_MAX_RESTARTS
+)
+from formatting import parse_text, clean_entities, dump_entities, load_entities
+from metrics import registry
+
+RECORD_QUERY = '''
+    SELECT u.user_id, u.phone, u.session_string, u.created_at, u.session_expired,
+           m.message_text, m.media_path, m.entities, COALESCE(s.is_active, 0) AS is_active,
+           COALESCE(s.flood_until, 0) AS flood_until, COALESCE(s.pace, 1) AS pace
+    FROM users u
+    LEFT JOIN messages m ON m.user_id = u.user_id
+    LEFT JOIN sending_state s ON s.user_id = u.user_id
+'''
+
+SENDING_UPSERT = '''
+    INSERT INTO sending_state (user_id, is_active, last_sent)
+    VALUES (?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(user_id) DO UPDATE SET is_active = excluded.is_active, last_sent = excluded.last_sent
+'''
+
+class BackupRestarted(Exception):
+    pass
+
+class UserRecord:
+    """In-memory copy of a user with message and sending state"""
+    __slots__ = (
+        'user_id', 'phone', 'session_string', 'created_at', 'session_expired',
+        'message_text', 'media_path', 'entities', 'is_active', 'flood_until', 'pace', 'targets',
+        'disabled_targets'
+    )
+    
+    def __init__(self, row):
+        self.user_id = row['user_id']
+        self.phone = row['phone']
+        self.session_string = row['session_string']
+        self.created_at = row['created_at']
+        self.session_expired = bool(row['session_expired'])
+        self.message_text = row['message_text']
+        self.media_path = row['media_path']
+        if row['entities'] is not None:
+            self.entities = load_entities(row['entities'])
+        elif self.message_text:
+            # Adverts saved before entities were stored used markdown
+            self.message_text, self.entities = parse_text(self.message_text, 'md')
+        else:
+            self.entities = []
+        self.is_active = bool(row['is_active'])
+        self.flood_until = row['flood_until']
+        self.pace = row['pace']
+        self.targets = {}
+        self.disabled_targets = set()
+    
+    @property
+    def has_own_targets(self):
+        """User set own groups, even if all of them are disabled now"""
+        return bool(self.targets or self.disabled_targets)
+    
+    def as_dict(self):
+        return {
+            'user_id': self.user_id,
+            'phone': self.phone,
+            'session_string': self.session_string,
+            'created_at': self.created_at,
+            'session_expired': self.session_expired
+        }
+
+def shard_of(user_id, shards):
+    """Worker process that owns the user's account"""
+    return (user_id * 2654435761 % 2**32) % shards
 
 class Database:
-    def __init__(self, db_path='data.db'):
+    def __init__(self, db_path='data.db', cache_size=USER_CACHE_SIZE, shard=None):
         self.db_path = db_path
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self._settings_lock = threading.Lock()
+        self.settings = {}
+        self.settings_version = 0
+        self.subscribers = []
+        self.record_subscribers = []
+        self._records_lock = threading.RLock()
+        self.records = OrderedDict()
+        self.cache_size = cache_size
+        # (index, count) of a sender worker, only its own users are preloaded
+        self.shard = shard
+        self.records_complete = False
         self.init_db()
+        self.load_settings()
+        self.load_records()
+    
+    def _connect(self):
+        """Return long-lived connection of the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=30,
+                check_same_thread=False,
+                cached_statements=DB_STATEMENT_CACHE
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA cache_size=-{DB_CACHE_KB}')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
     
     @contextmanager
     def get_conn(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        conn = self._connect()
+        local = self._local
+        local.depth = getattr(local, 'depth', 0) + 1
         try:
             yield conn
             conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
         finally:
-            conn.close()
+            local.depth -= 1
+        if not local.depth and getattr(local, 'changed', None):
+            self._notify_records()
+    
+    def close(self):
+        """Close connections of all threads"""
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+    
+    def _add_column(self, conn, table, column, decl):
+        """Add column to a table created by an older version"""
+        columns = [r['name'] for r in conn.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
     
     def init_db(self):
         with self.get_conn() as conn:
@@ -24,25 +160,35 @@ class Database:
                     user_id INTEGER PRIMARY KEY,
                     phone TEXT NOT NULL,
                     session_string TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    session_expired INTEGER DEFAULT 0
                 )
             ''')
+            self._add_column(conn, 'users', 'session_expired', 'INTEGER DEFAULT 0')
             
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS messages (
                     user_id INTEGER PRIMARY KEY,
                     message_text TEXT NOT NULL,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    media_path TEXT,
+                    entities TEXT
                 )
             ''')
+            self._add_column(conn, 'messages', 'media_path', 'TEXT')
+            self._add_column(conn, 'messages', 'entities', 'TEXT')
             
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS sending_state (
                     user_id INTEGER PRIMARY KEY,
                     is_active INTEGER DEFAULT 0,
-                    last_sent TIMESTAMP
+                    last_sent TIMESTAMP,
+                    flood_until REAL DEFAULT 0,
+                    pace REAL DEFAULT 1
                 )
             ''')
+            self._add_column(conn, 'sending_state', 'flood_until', 'REAL DEFAULT 0')
+            self._add_column(conn, 'sending_state', 'pace', 'REAL DEFAULT 1')
             
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS settings (
@@ -51,8 +197,56 @@ class Database:
                 )
             ''')
             
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS peer_cache (
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    peer_type TEXT NOT NULL,
+                    peer_id INTEGER NOT NULL,
+                    access_hash INTEGER,
+                    PRIMARY KEY (user_id, chat_id)
+                )
+            ''')
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    user_id INTEGER PRIMARY KEY,
+                    media_path TEXT NOT NULL,
+                    photo_id INTEGER NOT NULL,
+                    access_hash INTEGER NOT NULL,
+                    file_reference BLOB NOT NULL
+                )
+            ''')
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_targets (
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    fail_count INTEGER DEFAULT 0,
+                    last_error TEXT,
+                    disabled INTEGER DEFAULT 0,
+                    PRIMARY KEY (user_id, chat_id)
+                )
+            ''')
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS send_log (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER,
+                    sent_at REAL NOT NULL,
+                    outcome TEXT NOT NULL,
+                    latency REAL,
+                    error TEXT
+                )
+            ''')
+            
             conn.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON users(user_id)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_active ON sending_state(is_active)')
+            # Serves both the last success lookup and deleting a user's history
+            conn.execute('DROP INDEX IF EXISTS idx_send_log_ok')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_send_log_user ON send_log(user_id, outcome, sent_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_send_log_time ON send_log(sent_at)')
             
             conn.execute('''
                 INSERT OR IGNORE INTO settings (key, value) VALUES ('interval', ?)
@@ -64,25 +258,32 @@ class Database:
                 INSERT OR REPLACE INTO users (user_id, phone, session_string)
                 VALUES (?, ?, ?)
             ''', (user_id, phone, session_string))
+            # Access hashes belong to the account, a new login may be another one
+            conn.execute('DELETE FROM peer_cache WHERE user_id = ?', (user_id,))
+            self._cache_record(self._fetch_record(conn, user_id))
+            self._record_changed(user_id)
     
     def get_user(self, user_id):
-        with self.get_conn() as conn:
-            cur = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            row = cur.fetchone()
-            if row:
-                return {
-                    'user_id': row['user_id'],
-                    'phone': row['phone'] if 'phone' in row.keys() else '',
-                    'session_string': row['session_string'] if 'session_string' in row.keys() else '',
-                    'created_at': row['created_at'] if 'created_at' in row.keys() else ''
-                }
-            return None
+        record = self.get_record(user_id)
+        return record.as_dict() if record else None
     
     def delete_user(self, user_id):
         with self.get_conn() as conn:
             conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
             conn.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
             conn.execute('DELETE FROM sending_state WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM peer_cache WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM media_cache WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM user_targets WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM send_log WHERE user_id = ?', (user_id,))
+        with self._records_lock:
+            self.records.pop(user_id, None)
+        self._record_changed(user_id)
+    
+    def set_session_expired(self, user_id, expired=True):
+        with self.get_conn() as conn:
+            conn.execute('UPDATE users SET session_expired = ? WHERE user_id = ?', (1 if expired else 0, user_id))
+        self._update_record(user_id, session_expired=bool(expired))
     
     def get_all_users(self):
         with self.get_conn() as conn:
@@ -90,27 +291,98 @@ class Database:
             rows = cur.fetchall()
             return [{'user_id': r['user_id'], 'phone': r['phone'], 'session_string': r['session_string']} for r in rows]
     
-    def save_message(self, user_id, message_text):
+    def save_message(self, user_id, message_text, media_path=None, entities=None, parse_mode=None):
+        """Save advert, formatting is parsed here once and stored as entities"""
+        if parse_mode:
+            message_text, entities = parse_text(message_text, parse_mode)
+        entities = clean_entities(entities)
+        with self.get_conn() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO messages (user_id, message_text, updated_at, media_path, entities)
+                VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?)
+            ''', (user_id, message_text, media_path, dump_entities(entities)))
+            conn.execute('DELETE FROM media_cache WHERE user_id = ?', (user_id,))
+        self._update_record(user_id, message_text=message_text, media_path=media_path, entities=entities)
+    
+    def get_media(self, user_id, media_path):
+        """Uploaded photo (id, access_hash, file_reference) of user's advert media"""
+        with self.get_conn() as conn:
+            cur = conn.execute(
+                'SELECT photo_id, access_hash, file_reference FROM media_cache WHERE user_id = ? AND media_path = ?',
+                (user_id, media_path)
+            )
+            row = cur.fetchone()
+            return (row['photo_id'], row['access_hash'], row['file_reference']) if row else None
+    
+    def save_media(self, user_id, media_path, photo_id, access_hash, file_reference):
         with self.get_conn() as conn:
             conn.execute('''
-                INSERT OR REPLACE INTO messages (user_id, message_text, updated_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, message_text))
+                INSERT OR REPLACE INTO media_cache (user_id, media_path, photo_id, access_hash, file_reference)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, media_path, photo_id, access_hash, file_reference))
+    
+    def delete_media(self, user_id):
+        with self.get_conn() as conn:
+            conn.execute('DELETE FROM media_cache WHERE user_id = ?', (user_id,))
     
     def get_message(self, user_id):
+        record = self.get_record(user_id)
+        if record:
+            return record.message_text
+        if self.is_cached(user_id):
+            # Cache holds every user, this one has no account
+            return None
         with self.get_conn() as conn:
             cur = conn.execute('SELECT message_text FROM messages WHERE user_id = ?', (user_id,))
             row = cur.fetchone()
             return row['message_text'] if row else None
     
     def set_sending_active(self, user_id, is_active):
+        self.set_sending_active_many([user_id], is_active)
+    
+    def set_sending_active_many(self, user_ids, is_active):
+        """Switch sending of many users in one transaction"""
+        with self.get_conn() as conn:
+            conn.executemany(SENDING_UPSERT, ((user_id, 1 if is_active else 0) for user_id in user_ids))
+        for user_id in user_ids:
+            self._update_record(user_id, is_active=bool(is_active))
+    
+    def set_backoff(self, user_id, flood_until, pace):
+        """Store FloodWait deadline (unix time) and interval multiplier"""
         with self.get_conn() as conn:
             conn.execute('''
-                INSERT OR REPLACE INTO sending_state (user_id, is_active, last_sent)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, 1 if is_active else 0))
+                INSERT INTO sending_state (user_id, flood_until, pace) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET flood_until = excluded.flood_until, pace = excluded.pace
+            ''', (user_id, flood_until, pace))
+        self._update_record(user_id, flood_until=flood_until, pace=pace)
+    
+    def deactivate_all(self):
+        """Stop sending for everyone, return ids that were active"""
+        with self.get_conn() as conn:
+            cur = conn.execute('SELECT user_id FROM sending_state WHERE is_active = 1')
+            user_ids = [r['user_id'] for r in cur.fetchall()]
+            conn.execute('UPDATE sending_state SET is_active = 0, last_sent = CURRENT_TIMESTAMP WHERE is_active = 1')
+        for user_id in user_ids:
+            self._update_record(user_id, is_active=False)
+        return user_ids
+    
+    def get_resumable_user_ids(self):
+        """Stopped users with a message and a valid session"""
+        with self.get_conn() as conn:
+            cur = conn.execute('''
+                SELECT u.user_id FROM users u
+                JOIN messages m ON m.user_id = u.user_id
+                LEFT JOIN sending_state s ON s.user_id = u.user_id
+                WHERE u.session_expired = 0 AND COALESCE(s.is_active, 0) = 0
+            ''')
+            return [r['user_id'] for r in cur.fetchall()]
     
     def is_sending_active(self, user_id):
+        record = self.get_record(user_id)
+        if record:
+            return record.is_active
+        if self.is_cached(user_id):
+            return False
         with self.get_conn() as conn:
             cur = conn.execute('SELECT is_active FROM sending_state WHERE user_id = ?', (user_id,))
             row = cur.fetchone()
@@ -125,26 +397,386 @@ class Database:
             ''')
             return [dict(row) for row in cur.fetchall()]
     
-    def set_target_group(self, group_id):
+    def get_counts(self):
+        """Total users, active senders and expired sessions"""
+        with self.get_conn() as conn:
+            row = conn.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM users) AS total,
+                    (SELECT COUNT(*) FROM sending_state s JOIN users u ON u.user_id = s.user_id
+                     WHERE s.is_active = 1) AS active,
+                    (SELECT COUNT(*) FROM users WHERE session_expired = 1) AS expired
+            ''').fetchone()
+            return dict(row)
+    
+    def get_users_page(self, after_id=None, before_id=None, limit=USERS_PAGE_SIZE):
+        """Keyset page of users ordered by id, returns (users, has_prev, has_next)"""
+        query = '''
+            SELECT u.user_id, u.phone, u.session_expired, COALESCE(s.is_active, 0) AS is_active,
+                   (SELECT MAX(l.sent_at) FROM send_log l WHERE l.user_id = u.user_id AND l.outcome = 'ok') AS last_ok
+            FROM users u
+            LEFT JOIN sending_state s ON s.user_id = u.user_id
+        '''
+        with self.get_conn() as conn:
+            if before_id is not None:
+                cur = conn.execute(query + ' WHERE u.user_id < ? ORDER BY u.user_id DESC LIMIT ?', (before_id, limit + 1))
+                rows = cur.fetchall()
+                has_prev, has_next = len(rows) > limit, True
+                rows = rows[:limit][::-1]
+            else:
+                cur = conn.execute(query + ' WHERE u.user_id > ? ORDER BY u.user_id LIMIT ?', (after_id or 0, limit + 1))
+                rows = cur.fetchall()
+                has_prev, has_next = after_id is not None, len(rows) > limit
+                rows = rows[:limit]
+            return [dict(r) for r in rows], has_prev, has_next
+    
+    def owns(self, user_id):
+        """Check if user belongs to the shard of this instance"""
+        return self.shard is None or shard_of(user_id, self.shard[1]) == self.shard[0]
+    
+    def load_records(self):
+        """Fill user cache with own users, active senders first when it is bounded"""
+        query = RECORD_QUERY + ' ORDER BY is_active DESC'
+        if self.cache_size and self.shard is None:
+            query += f' LIMIT {self.cache_size + 1}'
+        limit = self.cache_size + 1 if self.cache_size else None
+        with self.get_conn() as conn:
+            cur = conn.execute(query)
+            rows = list(islice((r for r in cur if self.owns(r['user_id'])), limit))
+            targets = conn.execute('SELECT user_id, chat_id, fail_count, disabled FROM user_targets').fetchall()
+        with self._records_lock:
+            self.records = OrderedDict()
+            for row in rows[:self.cache_size or None]:
+                self.records[row['user_id']] = UserRecord(row)
+            for row in targets:
+                record = self.records.get(row['user_id'])
+                if record is None:
+                    continue
+                if row['disabled']:
+                    record.disabled_targets.add(row['chat_id'])
+                else:
+                    record.targets[row['chat_id']] = row['fail_count']
+            self.records_complete = not self.cache_size or len(rows) <= self.cache_size
+    
+    def _fetch_record(self, conn, user_id):
+        row = conn.execute(RECORD_QUERY + ' WHERE u.user_id = ?', (user_id,)).fetchone()
+        if not row:
+            return None
+        record = UserRecord(row)
+        for name, value in self._fetch_targets(conn, user_id).items():
+            setattr(record, name, value)
+        return record
+    
+    def _fetch_targets(self, conn, user_id):
+        """Record fields of user's targets: enabled ones with failures and disabled ids"""
+        cur = conn.execute('SELECT chat_id, fail_count, disabled FROM user_targets WHERE user_id = ?', (user_id,))
+        rows = cur.fetchall()
+        return {
+            'targets': {r['chat_id']: r['fail_count'] for r in rows if not r['disabled']},
+            'disabled_targets': {r['chat_id'] for r in rows if r['disabled']},
+        }
+    
+    def _cache_record(self, record):
+        with self._records_lock:
+            self.records[record.user_id] = record
+            self.records.move_to_end(record.user_id)
+            if self.cache_size and len(self.records) > self.cache_size:
+                self.records.popitem(last=False)
+                self.records_complete = False
+    
+    def _update_record(self, user_id, **fields):
+        with self._records_lock:
+            record = self.records.get(user_id)
+            if record:
+                for name, value in fields.items():
+                    setattr(record, name, value)
+        self._record_changed(user_id)
+    
+    def _record_changed(self, user_id):
+        """Queue change notification, sent once the transaction is committed"""
+        if not self.record_subscribers:
+            return
+        local = self._local
+        if not hasattr(local, 'changed'):
+            local.changed = set()
+        local.changed.add(user_id)
+        if not getattr(local, 'depth', 0):
+            self._notify_records()
+    
+    def _notify_records(self):
+        user_ids, self._local.changed = self._local.changed, set()
+        for callback in self.record_subscribers:
+            callback(user_ids)
+    
+    def subscribe_records(self, callback):
+        """Call callback(user_ids) after users were changed through this instance"""
+        self.record_subscribers.append(callback)
+    
+    def reload_records(self, user_ids):
+        """Drop cached users and read them again, they were changed by another process"""
+        with self._records_lock:
+            for user_id in user_ids:
+                self.records.pop(user_id, None)
+        try:
+            with self.get_conn() as conn:
+                records = [self._fetch_record(conn, user_id) for user_id in user_ids]
+        except sqlite3.Error:
+            # Dropped users are not gone, later lookups must go to SQL
+            self.records_complete = False
+            raise
+        for record in records:
+            if record:
+                self._cache_record(record)
+        return records
+    
+    def is_cached(self, user_id):
+        """Check if user lookup can be answered without SQL"""
+        return user_id in self.records or (self.records_complete and self.owns(user_id))
+    
+    def get_record(self, user_id):
+        """UserRecord of user or None, loaded into cache on miss"""
+        with self._records_lock:
+            record = self.records.get(user_id)
+            if record:
+                self.records.move_to_end(user_id)
+                return record
+            if self.records_complete and self.owns(user_id):
+                return None
+        with self.get_conn() as conn:
+            record = self._fetch_record(conn, user_id)
+        # Other shards' users are not reloaded here when they change
+        if record and self.owns(user_id):
+            self._cache_record(record)
+        return record
+    
+    def load_settings(self):
+        """Read settings table into memory, notify subscribers of changed keys"""
+        with self.get_conn() as conn:
+            rows = conn.execute('SELECT key, value FROM settings').fetchall()
+        with self._settings_lock:
+            old, self.settings = self.settings, {r['key']: r['value'] for r in rows}
+            self.settings_version += 1
+            version = self.settings_version
+        for key, value in self.settings.items():
+            if old.get(key) != value:
+                for callback in self.subscribers:
+                    callback(key, value, version)
+    
+    def subscribe(self, callback):
+        """Call callback(key, value, version) after every settings change"""
+        self.subscribers.append(callback)
+    
+    def set_setting(self, key, value):
         with self.get_conn() as conn:
             conn.execute('''
-                INSERT OR REPLACE INTO settings (key, value) VALUES ('target_group', ?)
-            ''', (str(group_id),))
+                INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)
+            ''', (key, str(value)))
+        with self._settings_lock:
+            self.settings[key] = str(value)
+            self.settings_version += 1
+            version = self.settings_version
+        for callback in self.subscribers:
+            callback(key, str(value), version)
     
-    def get_target_group(self):
+    def backup(self, dest_path, pages=BACKUP_PAGES, pause=BACKUP_PAUSE, max_restarts=BACKUP_MAX_RESTARTS):
+        """Consistent copy through SQLite online backup in small steps, returns timings"""
+        stats = {'pages': 0, 'steps': 0, 'restarts': 0, 'one_step': False, 'lock_seconds': 0.0}
+        remaining_before = None
+        step_start = time.perf_counter()
+        
+        def progress(status, remaining, total):
+            nonlocal remaining_before, step_start
+            stats['lock_seconds'] += time.perf_counter() - step_start
+            stats['steps'] += 1
+            stats['pages'] = total
+            if remaining_before is not None and remaining > remaining_before:
+                # Source was written by another connection, copy starts over
+                stats['restarts'] += 1
+                if stats['restarts'] > max_restarts:
+                    raise BackupRestarted()
+            remaining_before = remaining
+            # Writers get the database between steps
+            time.sleep(pause)
+            step_start = time.perf_counter()
+        
+        start = time.perf_counter()
+        src = sqlite3.connect(self.db_path, timeout=30)
+        dst = sqlite3.connect(dest_path)
+        try:
+            try:
+                src.backup(dst, pages=pages, progress=progress)
+            except BackupRestarted:
+                # Too busy for small steps, WAL readers do not block writers anyway
+                stats['one_step'] = True
+                step_start = time.perf_counter()
+                src.backup(dst)
+                stats['lock_seconds'] += time.perf_counter() - step_start
+            stats['check'] = dst.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            src.close()
+            dst.close()
+        
+        stats['seconds'] = round(time.perf_counter() - start, 3)
+        stats['lock_seconds'] = round(stats['lock_seconds'], 3)
+        return stats
+    
+    def add_send_log(self, rows):
+        """Write (user_id, chat_id, sent_at, outcome, latency, error) rows in one transaction"""
         with self.get_conn() as conn:
-            cur = conn.execute('SELECT value FROM settings WHERE key = ?', ('target_group',))
-            row = cur.fetchone()
-            return int(row['value']) if row else None
+            conn.executemany(
+                'INSERT INTO send_log (user_id, chat_id, sent_at, outcome, latency, error) VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
     
-    def set_interval(self, seconds):
+    def get_last_success(self, user_id):
+        """Unix time of last successful send of user, None if never"""
+        with self.get_conn() as conn:
+            row = conn.execute(
+                "SELECT MAX(sent_at) AS sent_at FROM send_log WHERE user_id = ? AND outcome = 'ok'",
+                (user_id,)
+            ).fetchone()
+            return row['sent_at']
+    
+    def prune_send_log(self, before):
+        """Drop delivery history older than unix time before"""
+        with self.get_conn() as conn:
+            return conn.execute('DELETE FROM send_log WHERE sent_at < ?', (before,)).rowcount
+    
+    def add_target(self, user_id, chat_id):
+        """Add target group of user, enabling it again if it was disabled"""
         with self.get_conn() as conn:
             conn.execute('''
-                INSERT OR REPLACE INTO settings (key, value) VALUES ('interval', ?)
-            ''', (str(seconds),))
+                INSERT INTO user_targets (user_id, chat_id) VALUES (?, ?)
+                ON CONFLICT(user_id, chat_id) DO UPDATE SET fail_count = 0, last_error = NULL, disabled = 0
+            ''', (user_id, chat_id))
+            self._update_record(user_id, **self._fetch_targets(conn, user_id))
     
-    def get_interval(self):
+    def remove_target(self, user_id, chat_id):
         with self.get_conn() as conn:
-            cur = conn.execute('SELECT value FROM settings WHERE key = ?', ('interval',))
+            conn.execute('DELETE FROM user_targets WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+            self._update_record(user_id, **self._fetch_targets(conn, user_id))
+    
+    def get_targets(self, user_id):
+        """All target groups of user with their failure state"""
+        with self.get_conn() as conn:
+            cur = conn.execute(
+                'SELECT chat_id, fail_count, last_error, disabled FROM user_targets WHERE user_id = ? ORDER BY chat_id',
+                (user_id,)
+            )
+            return [dict(r) for r in cur.fetchall()]
+    
+    def record_target_result(self, user_id, chat_id, error=None, disable=False):
+        """Reset failures after a success, or count a failure and maybe disable target"""
+        with self.get_conn() as conn:
+            if error is None:
+                conn.execute(
+                    'UPDATE user_targets SET fail_count = 0, last_error = NULL WHERE user_id = ? AND chat_id = ?',
+                    (user_id, chat_id)
+                )
+            else:
+                conn.execute('''
+                    UPDATE user_targets
+                    SET fail_count = fail_count + 1, last_error = ?,
+                        disabled = CASE WHEN ? OR fail_count + 1 >= ? THEN 1 ELSE disabled END
+                    WHERE user_id = ? AND chat_id = ?
+                ''', (error, 1 if disable else 0, TARGET_MAX_FAILURES, user_id, chat_id))
+            self._update_record(user_id, **self._fetch_targets(conn, user_id))
+    
+    def get_peer(self, user_id, chat_id):
+        """Cached (peer_type, peer_id, access_hash) of chat for user's account"""
+        with self.get_conn() as conn:
+            cur = conn.execute(
+                'SELECT peer_type, peer_id, access_hash FROM peer_cache WHERE user_id = ? AND chat_id = ?',
+                (user_id, chat_id)
+            )
             row = cur.fetchone()
-            return int(row['value']) if row else DEFAULT_INTERVAL
\ No newline at end of file
+            return (row['peer_type'], row['peer_id'], row['access_hash']) if row else None
+    
+    def save_peer(self, user_id, chat_id, peer_type, peer_id, access_hash):
+        with self.get_conn() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO peer_cache (user_id, chat_id, peer_type, peer_id, access_hash)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, chat_id, peer_type, peer_id, access_hash))
+    
+    def delete_peers(self, chat_id=None, user_id=None):
+        """Forget resolved peers of a chat, of a user or both"""
+        with self.get_conn() as conn:
+            conn.execute(
+                'DELETE FROM peer_cache WHERE (? IS NULL OR chat_id = ?) AND (? IS NULL OR user_id = ?)',
+                (chat_id, chat_id, user_id, user_id)
+            )
+    
+    def set_target_group(self, group_id):
+        old = self.get_target_group()
+        if old is not None and old != int(group_id):
+            self.delete_peers(chat_id=old)
+        self.set_setting('target_group', group_id)
+    
+    def get_target_group(self):
+        value = self.settings.get('target_group')
+        return int(value) if value is not None else None
+    
+    def set_interval(self, seconds):
+        self.set_setting('interval', seconds)
+    
+    def get_interval(self):
+        value = self.settings.get('interval')
+        return int(value) if value is not None else DEFAULT_INTERVAL
+
+class AsyncDatabase:
+    """Awaitable Database API, queries run on a dedicated executor thread"""
+    
+    # Served from memory, no need to leave the event loop
+    SETTINGS = {'get_target_group', 'get_interval'}
+    RECORDS = {'get_record', 'get_user', 'get_message', 'is_sending_active'}
+    # Long running, own connection and thread so queries are not held up
+    BACKGROUND = {'backup'}
+    
+    def __init__(self, db):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+    
+    def subscribe(self, callback):
+        self.db.subscribe(callback)
+    
+    def subscribe_records(self, callback):
+        self.db.subscribe_records(callback)
+    
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+        
+        if name in self.SETTINGS:
+            async def call(*args, **kwargs):
+                return attr(*args, **kwargs)
+        elif name in self.BACKGROUND:
+            async def call(*args, **kwargs):
+                return await asyncio.to_thread(attr, *args, **kwargs)
+        elif name in self.RECORDS:
+            async def call(user_id):
+                if self.db.is_cached(user_id):
+                    return attr(user_id)
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, attr, user_id)
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    registry.observe('db_query_seconds', time.perf_counter() - start, query=name)
+            
+            async def call(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, partial(timed, *args, **kwargs))
+        
+        call.__name__ = name
+        setattr(self, name, call)
+        return call
+    
+    def close(self):
+        """Finish pending queries and close connections"""
+        self.executor.shutdown(wait=True)
+        self.db.close()
@@ -0,0 +1,47 @@
+import json
+import re
+from telethon import helpers
+from telethon.extensions import html, markdown
+from telethon.tl import types
+
+PARSERS = {'md': markdown.parse, 'markdown': markdown.parse, 'html': html.parse}
+
+# Links Telethon turns into user mentions, they need an InputUser of the sending account
+MENTION_URL = re.compile(r'^@|\+|tg://user\?id=(\d+)')
+MENTIONS = (types.MessageEntityMentionName, types.InputMessageEntityMentionName)
+
+def clean_entities(entities):
+    """Entities that can be sent as formatting_entities by any account
+
+    Telethon fixes these up only when it parses the text itself: zero-length
+    entities are invalid and user mentions must be resolved per account.
+    They are dropped, the mention text stays as plain text.
+    """
+    return [
+        e for e in entities or []
+        if e.length and not isinstance(e, MENTIONS)
+        and not (isinstance(e, types.MessageEntityTextUrl) and MENTION_URL.match(e.url))
+    ]
+
+def parse_text(text, parse_mode):
+    """Split formatted text into plain text and message entities"""
+    text, entities = PARSERS[parse_mode](text)
+    return text, clean_entities(entities)
+
+def strip_entities(text, entities):
+    """Strip surrounding whitespace, keeping entity offsets valid"""
+    entities = list(entities or [])
+    return helpers.strip_text(text, entities), entities
+
+def dump_entities(entities):
+    """Message entities as JSON for storage"""
+    return json.dumps([e.to_dict() for e in entities or []])
+
+def load_entities(data):
+    """Message entities from stored JSON"""
+    result = []
+    for item in json.loads(data):
+        item = dict(item)
+        cls = getattr(types, item.pop('_'))
+        result.append(cls(**item))
+    return clean_entities(result)
@@ -1,20 +1,33 @@
 import asyncio
 import logging
+import os
+import time
 from telethon import TelegramClient, events, Button
 from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, FloodWaitError
-from config import API_ID, API_HASH, BOT_TOKEN, ADMIN_ID
-from db import Database
-from mtproto import MTProtoManager
+from config import API_ID, API_HASH, BOT_TOKEN, ADMIN_ID, MEDIA_DIR, MAX_USER_TARGETS, METRICS_PORT, SHARDS
+from db import Database, AsyncDatabase
+from mtproto import MTProtoManager, process_rss
 from scheduler import Scheduler
+from shard import ShardCoordinator
+from backup import Backups
+from router import CallbackRouter
+from states import LoginStates
+from formatting import strip_entities
+from metrics import registry
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-user_states = {}
+user_states = LoginStates()
+
+NO_TEXT = "❌ Yo'q"
+
+def format_time(timestamp):
+    return time.strftime('%d.%m %H:%M', time.localtime(timestamp)) if timestamp else NO_TEXT
 
 async def start_handler(event):
     user_id = event.sender_id
-    user = event.client.db.get_user(user_id)
+    user = await event.client.db.get_user(user_id)
     
     markup = [[Button.inline("👥 Profil", b"profile")]]
     if user:
@@ -26,7 +39,7 @@ async def start_handler(event):
     
     text = "🚕 Taksi haydovchilari uchun avto-posting tizimi\n\n"
     if user:
-        status = "✅ Faol" if event.client.scheduler.is_active(user_id) else "⏸ To'xtatilgan"
+        status = "✅ Faol" if await event.client.scheduler.is_active(user_id) else "⏸ To'xtatilgan"
         text += f"Status: {status}\n\n"
     text += "Guruhga avtomatik xabar yuborish uchun profilingizni sozlang."
     
@@ -37,7 +50,7 @@ async def start_handler(event):
 
 async def profile_handler(event):
     user_id = event.sender_id
-    user = event.client.db.get_user(user_id)
+    user = await event.client.db.get_user(user_id)
     
     if user:
         markup = [
@@ -45,6 +58,8 @@ async def profile_handler(event):
             [Button.inline("🔙 Orqaga", b"back_main")]
         ]
         text = f"👥 Profil boshqaruvi\n\n✅ Profil mavjud\nTelefon: {user['phone']}"
+        if user['session_expired']:
+            text += "\n\n⚠️ Sessiya muddati tugagan. Profilni o'chirib qayta qo'shing."
     else:
         markup = [
             [Button.inline("➕ Profil qo'shish", b"add_profile")],
@@ -56,6 +71,10 @@ async def profile_handler(event):
 
 async def add_profile_handler(event):
     user_id = event.sender_id
+    if user_states.is_full(user_id):
+        await event.answer("⏳ Hozir so'rovlar ko'p, birozdan keyin urinib ko'ring", alert=True)
+        return
+    
     user_states[user_id] = {'step': 'phone'}
     
     await event.edit(
@@ -79,7 +98,7 @@ async def message_handler(event):
         if state.get('step') == 'admin_set_target':
             try:
                 group_id = int(event.raw_text.strip())
-                event.client.db.set_target_group(group_id)
+                await event.client.db.set_target_group(group_id)
                 await event.respond("✅ Maqsadli guruh o'rnatildi", buttons=[[Button.inline("🔙 Admin Panel", b"admin")]])
                 del user_states[ADMIN_ID]
                 return
@@ -93,7 +112,7 @@ async def message_handler(event):
                 if interval < 60:
                     await event.respond("❌ Interval kamida 60 soniya bo'lishi kerak")
                     return
-                event.client.db.set_interval(interval)
+                await event.client.db.set_interval(interval)
                 await event.respond(f"✅ Interval {interval} soniyaga o'rnatildi", buttons=[[Button.inline("🔙 Admin Panel", b"admin")]])
                 del user_states[ADMIN_ID]
                 return
@@ -111,13 +130,13 @@ async def message_handler(event):
         
         try:
             client = await event.client.mtproto_mgr.create_client(user_id)
+            state['client'] = client
             await client.connect()
             
             result = await client.send_code_request(phone)
             state['phone'] = phone
             state['phone_hash'] = result.phone_code_hash
             state['step'] = 'code'
-            state['client'] = client
             state['code_time'] = asyncio.get_event_loop().time()
             
             await event.respond(
@@ -130,11 +149,11 @@ async def message_handler(event):
             )
         except FloodWaitError as e:
             await event.respond(f"⏳ {e.seconds} soniyadan keyin qayta urinib ko'ring", buttons=[[Button.inline("🔙 Orqaga", b"profile")]])
-            del user_states[user_id]
+            user_states.discard(user_id)
         except Exception as e:
             logger.error(f"Phone error: {e}")
             await event.respond("❌ Xatolik yuz berdi. Qayta urinib ko'ring", buttons=[[Button.inline("🔙 Orqaga", b"profile")]])
-            del user_states[user_id]
+            user_states.discard(user_id)
     
     elif state.get('step') == 'code':
         code = event.raw_text.strip().replace('.', '').replace('-', '').replace(' ', '')
@@ -144,7 +163,8 @@ async def message_handler(event):
             await client.sign_in(state['phone'], code, phone_code_hash=state['phone_hash'])
             
             session_str = event.client.mtproto_mgr.save_session(user_id, client)
-            event.client.db.add_user(user_id, state['phone'], session_str)
+            await event.client.db.add_user(user_id, state['phone'], session_str)
+            await event.client.scheduler.adopt(user_id, client)
             
             await event.respond("✅ Profil muvaffaqiyatli qo'shildi!", buttons=[[Button.inline("🏠 Bosh menu", b"back_main")]])
             del user_states[user_id]
@@ -159,7 +179,7 @@ async def message_handler(event):
         except Exception as e:
             logger.error(f"Code error: {e}")
             await event.respond("❌ Xatolik yuz berdi", buttons=[[Button.inline("🔙 Orqaga", b"profile")]])
-            del user_states[user_id]
+            user_states.discard(user_id)
     
     elif state.get('step') == '2fa':
         password = event.raw_text.strip()
@@ -169,7 +189,8 @@ async def message_handler(event):
             await client.sign_in(password=password)
             
             session_str = event.client.mtproto_mgr.save_session(user_id, client)
-            event.client.db.add_user(user_id, state['phone'], session_str)
+            await event.client.db.add_user(user_id, state['phone'], session_str)
+            await event.client.scheduler.adopt(user_id, client)
             
             await event.respond("✅ Profil muvaffaqiyatli qo'shildi!", buttons=[[Button.inline("🏠 Bosh menu", b"back_main")]])
             del user_states[user_id]
@@ -178,9 +199,34 @@ async def message_handler(event):
             logger.error(f"2FA error: {e}")
             await event.respond("❌ Noto'g'ri parol. Qayta kiriting:")
     
+    elif state.get('step') == 'add_target':
+        try:
+            chat_id = int(event.raw_text.strip())
+        except ValueError:
+            await event.respond("❌ Noto'g'ri format. Raqam kiriting:")
+            return
+        
+        await event.client.db.add_target(user_id, chat_id)
+        await event.respond("✅ Guruh qo'shildi", buttons=[[Button.inline("🎯 Guruhlarim", b"targets")]])
+        del user_states[user_id]
+    
     elif state.get('step') == 'message_text':
-        message_text = event.raw_text.strip()
-        event.client.db.save_message(user_id, message_text)
+        # Keep user's own formatting, entities come already parsed by Telegram
+        message_text, entities = strip_entities(event.message.message, event.message.entities)
+        old = await event.client.db.get_record(user_id)
+        media_path = None
+        if event.photo:
+            media_path = await event.download_media(file=os.path.join(MEDIA_DIR, f"{user_id}_{event.id}.jpg"))
+        elif not message_text:
+            await event.respond("❌ Elon matni yoki rasm yuboring:")
+            return
+        
+        await event.client.db.save_message(user_id, message_text, media_path, entities)
+        if old and old.media_path and old.media_path != media_path:
+            try:
+                os.remove(old.media_path)
+            except OSError:
+                pass
         
         await event.respond("✅ Elon saqlandi!", buttons=[[Button.inline("🏠 Bosh menu", b"back_main")]])
         del user_states[user_id]
@@ -212,13 +258,7 @@ async def resend_code_handler(event):
 
 async def cancel_login_handler(event):
     user_id = event.sender_id
-    if user_id in user_states:
-        if 'client' in user_states[user_id]:
-            try:
-                await user_states[user_id]['client'].disconnect()
-            except:
-                pass
-        del user_states[user_id]
+    user_states.discard(user_id)
     await profile_handler(event)
 
 async def delete_profile_handler(event):
@@ -236,23 +276,33 @@ async def delete_profile_handler(event):
 async def confirm_delete_handler(event):
     user_id = event.sender_id
     
-    event.client.scheduler.stop_sender(user_id)
-    event.client.mtproto_mgr.delete_session(user_id)
-    event.client.db.delete_user(user_id)
+    record = await event.client.db.get_record(user_id)
+    await event.client.scheduler.stop_sender(user_id)
+    await event.client.mtproto_mgr.delete_session(user_id)
+    await event.client.db.delete_user(user_id)
+    await event.client.scheduler.forget_user(user_id)
+    if record and record.media_path:
+        try:
+            os.remove(record.media_path)
+        except OSError:
+            pass
     
     await event.edit("✅ Profil o'chirildi", buttons=[[Button.inline("🏠 Bosh menu", b"back_main")]])
 
 async def message_menu_handler(event):
     user_id = event.sender_id
     
-    if not event.client.db.get_user(user_id):
+    if not await event.client.db.get_user(user_id):
         await event.answer("❌ Avval profil qo'shing!", alert=True)
         return
     
-    msg = event.client.db.get_message(user_id)
+    record = await event.client.db.get_record(user_id)
+    msg = record.message_text
     
     text = "💬 Elon boshqaruvi\n\n"
-    if msg:
+    if msg is not None:
+        if record.media_path:
+            text += "🖼 Rasm biriktirilgan\n"
         text += f"📝 Joriy elon:\n{msg[:200]}{'...' if len(msg) > 200 else ''}"
     else:
         text += "❌ Elon topilmadi"
@@ -268,24 +318,26 @@ async def write_message_handler(event):
     user_id = event.sender_id
     user_states[user_id] = {'step': 'message_text'}
     await event.edit(
-        "✍️ Yangi elon matnini yuboring:",
+        "✍️ Yangi elon matnini yuboring.\n\n"
+        "🖼 Mashinangiz rasmini izoh bilan ham yuborishingiz mumkin.",
         buttons=[[Button.inline("🔙 Bekor qilish", b"message")]]
     )
 
 async def control_handler(event):
     user_id = event.sender_id
     
-    if not event.client.db.get_user(user_id):
+    if not await event.client.db.get_user(user_id):
         await event.answer("❌ Avval profil qo'shing!", alert=True)
         return
     
-    if not event.client.db.get_message(user_id):
+    if await event.client.db.get_message(user_id) is None:
         await event.answer("❌ Avval elon yozing!", alert=True)
         return
     
-    is_active = event.client.scheduler.is_active(user_id)
-    target = event.client.db.get_target_group()
-    interval = event.client.db.get_interval()
+    is_active = await event.client.scheduler.is_active(user_id)
+    record = await event.client.db.get_record(user_id)
+    target = await event.client.db.get_target_group()
+    interval = await event.client.db.get_interval()
     
     if is_active:
         markup = [[Button.inline("⏹ To'xtatish", b"stop_sending")]]
@@ -294,40 +346,101 @@ async def control_handler(event):
         markup = [[Button.inline("▶️ Boshlash", b"start_sending")]]
         status = "⏸ Yuborish to'xtatilgan"
     
+    markup.append([Button.inline("🎯 Guruhlarim", b"targets")])
     markup.append([Button.inline("🔙 Orqaga", b"back_main")])
     
     text = f"▶️ Boshqaruv paneli\n\n{status}\n\n"
     text += f"⏱ Interval: {interval} soniya ({interval//60} min {interval%60} sek)\n"
-    text += f"🎯 Guruh: {target if target else '❌ Belgilanmagan'}"
+    if record.has_own_targets:
+        text += f"🎯 Guruhlar: {len(record.targets)} ta"
+        if record.disabled_targets:
+            text += f" (o'chirilgan: {len(record.disabled_targets)})"
+        text += "\n"
+    else:
+        text += f"🎯 Guruh: {target if target else '❌ Belgilanmagan'}\n"
+    text += f"🕐 Oxirgi yuborish: {format_time(await event.client.scheduler.last_success(user_id))}"
     
     await event.edit(text, buttons=markup)
 
 async def start_sending_handler(event):
     user_id = event.sender_id
     
-    if not event.client.db.get_user(user_id):
+    if not await event.client.db.get_user(user_id):
         await event.answer("❌ Profil topilmadi", alert=True)
         return
     
-    if not event.client.db.get_message(user_id):
+    if await event.client.db.get_message(user_id) is None:
         await event.answer("❌ Elon topilmadi", alert=True)
         return
     
-    target = event.client.db.get_target_group()
-    if not target:
+    record = await event.client.db.get_record(user_id)
+    target = await event.client.db.get_target_group()
+    if record.has_own_targets and not record.targets:
+        await event.answer("❌ Barcha guruhlaringiz o'chirilgan, guruh qo'shing", alert=True)
+        return
+    if not target and not record.has_own_targets:
         await event.answer("❌ Admin hali maqsadli guruhni belgilamagan", alert=True)
         return
     
-    event.client.scheduler.start_sender(user_id)
+    await event.client.scheduler.start_sender(user_id)
     await event.answer("✅ Yuborish boshlandi!", alert=True)
     await control_handler(event)
 
 async def stop_sending_handler(event):
     user_id = event.sender_id
-    event.client.scheduler.stop_sender(user_id)
+    await event.client.scheduler.stop_sender(user_id)
     await event.answer("⏹ Yuborish to'xtatildi!", alert=True)
     await control_handler(event)
 
+async def targets_handler(event):
+    user_id = event.sender_id
+    
+    if not await event.client.db.get_user(user_id):
+        await event.answer("❌ Avval profil qo'shing!", alert=True)
+        return
+    
+    targets = await event.client.db.get_targets(user_id)
+    text = "🎯 Guruhlarim\n\n"
+    markup = []
+    
+    if targets:
+        for t in targets:
+            if t['disabled']:
+                text += f"⚠️ {t['chat_id']} — o'chirilgan ({t['last_error']})\n"
+            elif t['fail_count']:
+                text += f"❗ {t['chat_id']} — {t['fail_count']} ta xato\n"
+            else:
+                text += f"✅ {t['chat_id']}\n"
+            markup.append([Button.inline(f"🗑 {t['chat_id']}", f"target_del:{t['chat_id']}".encode())])
+        if all(t['disabled'] for t in targets):
+            text += "\n⛔️ Barcha guruhlar o'chirilgan, yuborish to'xtatiladi. Umumiy guruhga yuborilmaydi."
+    else:
+        target = await event.client.db.get_target_group()
+        text += f"Shaxsiy guruhlar yo'q, umumiy guruhga yuboriladi: {target if target else '❌ Belgilanmagan'}"
+    
+    markup.append([Button.inline("➕ Guruh qo'shish", b"target_add")])
+    markup.append([Button.inline("🔙 Orqaga", b"control")])
+    
+    await event.edit(text, buttons=markup)
+
+async def target_add_handler(event):
+    user_id = event.sender_id
+    
+    if len(await event.client.db.get_targets(user_id)) >= MAX_USER_TARGETS:
+        await event.answer(f"❌ Ko'pi bilan {MAX_USER_TARGETS} ta guruh qo'shish mumkin", alert=True)
+        return
+    
+    user_states[user_id] = {'step': 'add_target'}
+    await event.edit(
+        "🎯 Guruh ID sini yuboring:\n\n"
+        "Masalan: -1001234567890",
+        buttons=[[Button.inline("🔙 Bekor qilish", b"targets")]]
+    )
+
+async def target_del_handler(event, chat_id):
+    await event.client.db.remove_target(event.sender_id, int(chat_id))
+    await targets_handler(event)
+
 async def back_main_handler(event):
     await start_handler(event)
 
@@ -336,16 +449,43 @@ async def admin_panel_handler(event):
         await event.answer("❌ Ruxsat yo'q", alert=True)
         return
     
-    users = event.client.db.get_all_users()
-    active = event.client.scheduler.get_active_count()
-    target = event.client.db.get_target_group()
-    interval = event.client.db.get_interval()
+    counts = await event.client.db.get_counts()
+    active = counts['active']
+    target = await event.client.db.get_target_group()
+    interval = await event.client.db.get_interval()
     
     text = "🔧 Admin Panel\n\n"
-    text += f"👥 Foydalanuvchilar: {len(users)}\n"
+    text += f"👥 Foydalanuvchilar: {counts['total']}\n"
     text += f"✅ Faol: {active}\n"
-    text += f"🎯 Guruh: {target or '❌ Yo\'q'}\n"
-    text += f"⏱ Interval: {interval}s"
+    text += f"⚠️ Sessiyasi tugagan: {counts['expired']}\n"
+    text += f"🎯 Guruh: {target or NO_TEXT}\n"
+    text += f"⏱ Interval: {interval}s\n"
+    
+    status = await event.client.scheduler.status()
+    if 'shards' in status:
+        shards = status['shards']
+        text += f"🧩 Jarayonlar: {shards['alive']}/{shards['total']} (qayta ishga tushgan: {shards['restarts']})\n"
+    
+    pool = status.get('pool', {})
+    text += (
+        f"🔌 Ulanishlar: {pool.get('live', 0)}/{pool.get('max', 0)} "
+        f"(xotira {pool.get('rss_bytes', 0) // 2**20} MB)\n"
+    )
+    
+    logins = user_states.stats()
+    text += f"🔑 Kutilayotgan loginlar: {logins['size']} (muddati o'tgan: {logins['expired']})\n"
+    
+    limits = status.get('limiter', {}).get(str(target), {})
+    text += f"🚦 Navbat: {limits.get('queued', 0)} (o'rtacha kutish {limits.get('wait_avg', 0)}s)\n"
+    
+    sends = status.get('sends', {})
+    text += (
+        f"📤 Yuborish: {sends.get('busy_workers', 0)}/{sends.get('workers', 0)} ishchi, "
+        f"navbatda {sends.get('queued', 0)}, tashlangan {sends.get('full', 0) + sends.get('overdue', 0)}\n"
+    )
+    
+    latency = event.client.router.latency.stats()
+    text += f"⚡️ Tugmalar: o'rtacha {latency['avg_ms']} ms, p95 {latency['p95_ms']} ms, max {latency['max_ms']} ms"
     
     markup = [
         [Button.inline("🎯 Guruh o'zgartirish", b"admin_target")],
@@ -356,6 +496,8 @@ async def admin_panel_handler(event):
     
     if active > 0:
         markup.append([Button.inline("⏹ Barchasini to'xtatish", b"admin_stop_all")])
+    if active < counts['total']:
+        markup.append([Button.inline("▶️ Barchasini boshlash", b"admin_start_all")])
     
     markup.append([Button.inline("🔙 Orqaga", b"back_main")])
     
@@ -364,6 +506,15 @@ async def admin_panel_handler(event):
     except:
         await event.respond(text, buttons=markup)
 
+async def stats_handler(event):
+    if event.sender_id != ADMIN_ID:
+        return
+    
+    text = registry.summary(await event.client.scheduler.metric_snapshots())
+    latency = event.client.router.latency.stats()
+    text += f"\nhandler_p95_ms: {latency['p95_ms']}"
+    await event.respond(text[:4000])
+
 async def admin_target_handler(event):
     if event.sender_id != ADMIN_ID:
         return
@@ -395,39 +546,79 @@ async def admin_download_handler(event):
         return
     
     try:
-        await event.client.send_file(ADMIN_ID, 'data.db', caption="💾 Database fayli")
-        await event.answer("✅ Yuborildi", alert=True)
+        await event.answer("⏳ Nusxa tayyorlanmoqda...")
+        path, stats = await event.client.backups.create()
+        caption = (
+            f"💾 Database nusxasi\n"
+            f"{stats['db_bytes'] // 1024} KB → {stats['gz_bytes'] // 1024} KB, {stats['seconds']}s "
+            f"(bloklash {stats['lock_seconds']}s), tekshiruv: {stats['check']}"
+        )
+        await event.client.send_file(ADMIN_ID, path, caption=caption)
     except Exception as e:
         logger.error(f"DB download error: {e}")
-        await event.answer("❌ Xatolik yuz berdi", alert=True)
+        await event.respond("❌ Xatolik yuz berdi")
 
-async def admin_users_handler(event):
+async def admin_users_handler(event, cursor=''):
     if event.sender_id != ADMIN_ID:
         return
     
-    users = event.client.db.get_all_users()
+    # Cursor: >ID for next page, <ID for previous page
+    after_id = before_id = None
+    if cursor.startswith('>'):
+        after_id = int(cursor[1:])
+    elif cursor.startswith('<'):
+        before_id = int(cursor[1:])
+    
+    users, has_prev, has_next = await event.client.db.get_users_page(after_id, before_id)
+    if not users and cursor:
+        # Users of that page were deleted meanwhile, start from the beginning
+        users, has_prev, has_next = await event.client.db.get_users_page()
+    scheduler = event.client.scheduler
     text = "👥 Foydalanuvchilar ro'yxati:\n\n"
     
     if users:
-        for i, u in enumerate(users, 1):
-            status = "✅" if event.client.scheduler.is_active(u['user_id']) else "⏸"
-            text += f"{i}. {status} ID: {u['user_id']} | {u['phone']}\n"
+        for u in users:
+            status = "✅" if u['is_active'] else "⏸"
+            if u['session_expired']:
+                status += "⚠️"
+            # Rows still in the write buffer are newer than the table
+            last_ok = max(u['last_ok'] or 0, scheduler.recent_success(u['user_id']) or 0)
+            text += f"{status} ID: {u['user_id']} | {u['phone']} | 🕐 {format_time(last_ok)}\n"
     else:
         text = "❌ Foydalanuvchilar yo'q"
     
-    await event.edit(text, buttons=[[Button.inline("🔙 Orqaga", b"admin")]])
+    nav = []
+    if users and has_prev:
+        nav.append(Button.inline("⬅️", f"admin_users:<{users[0]['user_id']}".encode()))
+    if users and has_next:
+        nav.append(Button.inline("➡️", f"admin_users:>{users[-1]['user_id']}".encode()))
+    
+    markup = [nav] if nav else []
+    markup.append([Button.inline("🔙 Orqaga", b"admin")])
+    await event.edit(text, buttons=markup)
 
 async def admin_stop_all_handler(event):
     if event.sender_id != ADMIN_ID:
         return
     
-    users = event.client.db.get_active_users()
-    count = 0
-    for user in users:
-        event.client.scheduler.stop_sender(user['user_id'])
-        count += 1
+    outcomes = await event.client.scheduler.stop_all()
     
-    await event.answer(f"⏹ {count} ta yuborish to'xtatildi", alert=True)
+    await event.answer(f"⏹ {len(outcomes)} ta yuborish to'xtatildi", alert=True)
+    await admin_panel_handler(event)
+
+async def admin_start_all_handler(event):
+    if event.sender_id != ADMIN_ID:
+        return
+    
+    if not await event.client.db.get_target_group():
+        await event.answer("❌ Maqsadli guruh belgilanmagan", alert=True)
+        return
+    
+    user_ids = await event.client.db.get_resumable_user_ids()
+    outcomes = await event.client.scheduler.start_many(user_ids)
+    started = sum(1 for o in outcomes.values() if o == 'started')
+    
+    await event.answer(f"▶️ {started} ta yuborish boshlandi", alert=True)
     await admin_panel_handler(event)
 
 async def main():
@@ -438,47 +629,72 @@ async def main():
     try:
         await bot.start(bot_token=BOT_TOKEN)
         
-        db = Database()
-        mtproto_mgr = MTProtoManager()
-        scheduler = Scheduler(bot, db, mtproto_mgr)
+        db = AsyncDatabase(Database())
+        mtproto_mgr = MTProtoManager(db)
+        loop = asyncio.get_running_loop()
+        db.subscribe(lambda key, value, version: loop.call_soon_threadsafe(mtproto_mgr.on_setting, key, value))
+        if SHARDS:
+            scheduler = ShardCoordinator(db, mtproto_mgr, SHARDS)
+        else:
+            scheduler = Scheduler(bot, db, mtproto_mgr)
         
         bot.db = db
         bot.mtproto_mgr = mtproto_mgr
         bot.scheduler = scheduler
+        bot.backups = Backups(db)
+        
+        router = CallbackRouter()
+        bot.router = router
+        bot.add_event_handler(router.timed(start_handler), events.NewMessage(pattern='/start'))
+        bot.add_event_handler(stats_handler, events.NewMessage(pattern='/stats'))
+        router.add(b"profile", profile_handler)
+        router.add(b"add_profile", add_profile_handler)
+        router.add(b"resend_code", resend_code_handler)
+        router.add(b"cancel_login", cancel_login_handler)
+        router.add(b"delete_profile", delete_profile_handler)
+        router.add(b"confirm_delete", confirm_delete_handler)
+        router.add(b"message", message_menu_handler)
+        router.add(b"write_message", write_message_handler)
+        router.add(b"control", control_handler)
+        router.add(b"start_sending", start_sending_handler)
+        router.add(b"stop_sending", stop_sending_handler)
+        router.add(b"targets", targets_handler)
+        router.add(b"target_add", target_add_handler)
+        router.add(b"target_del", target_del_handler, arg=r'-?\d+')
+        router.add(b"back_main", back_main_handler)
+        router.add(b"admin", admin_panel_handler)
+        router.add(b"admin_target", admin_target_handler)
+        router.add(b"admin_interval", admin_interval_handler)
+        router.add(b"admin_download", admin_download_handler)
+        router.add(b"admin_users", admin_users_handler, arg=r'[<>]\d+')
+        router.add(b"admin_stop_all", admin_stop_all_handler)
+        router.add(b"admin_start_all", admin_start_all_handler)
+        bot.add_event_handler(router.dispatch, events.CallbackQuery())
+        bot.add_event_handler(router.timed(message_handler), events.NewMessage())
         
-        bot.add_event_handler(start_handler, events.NewMessage(pattern='/start'))
-        bot.add_event_handler(profile_handler, events.CallbackQuery(pattern=b"profile"))
-        bot.add_event_handler(add_profile_handler, events.CallbackQuery(pattern=b"add_profile"))
-        bot.add_event_handler(resend_code_handler, events.CallbackQuery(pattern=b"resend_code"))
-        bot.add_event_handler(cancel_login_handler, events.CallbackQuery(pattern=b"cancel_login"))
-        bot.add_event_handler(delete_profile_handler, events.CallbackQuery(pattern=b"delete_profile"))
-        bot.add_event_handler(confirm_delete_handler, events.CallbackQuery(pattern=b"confirm_delete"))
-        bot.add_event_handler(message_menu_handler, events.CallbackQuery(pattern=b"message"))
-        bot.add_event_handler(write_message_handler, events.CallbackQuery(pattern=b"write_message"))
-        bot.add_event_handler(control_handler, events.CallbackQuery(pattern=b"control"))
-        bot.add_event_handler(start_sending_handler, events.CallbackQuery(pattern=b"start_sending"))
-        bot.add_event_handler(stop_sending_handler, events.CallbackQuery(pattern=b"stop_sending"))
-        bot.add_event_handler(back_main_handler, events.CallbackQuery(pattern=b"back_main"))
-        bot.add_event_handler(admin_panel_handler, events.CallbackQuery(pattern=b"admin"))
-        bot.add_event_handler(admin_target_handler, events.CallbackQuery(pattern=b"admin_target"))
-        bot.add_event_handler(admin_interval_handler, events.CallbackQuery(pattern=b"admin_interval"))
-        bot.add_event_handler(admin_download_handler, events.CallbackQuery(pattern=b"admin_download"))
-        bot.add_event_handler(admin_users_handler, events.CallbackQuery(pattern=b"admin_users"))
-        bot.add_event_handler(admin_stop_all_handler, events.CallbackQuery(pattern=b"admin_stop_all"))
-        bot.add_event_handler(message_handler, events.NewMessage())
+        scheduler.register_metrics()
+        registry.gauge('login_states', lambda: len(user_states))
+        registry.gauge('asyncio_tasks', lambda: len(asyncio.all_tasks()))
+        registry.gauge('rss_bytes', process_rss)
+        if METRICS_PORT:
+            await registry.serve(METRICS_PORT)
         
+        mtproto_mgr.start_reaper()
+        user_states.start_sweeper()
+        bot.backups.start()
         await scheduler.restore_senders()
         logger.info("Bot faol! Telegram'da /start bosing")
         await bot.run_until_disconnected()
     
     finally:
         logger.info("Bot yopilmoqda...")
-        # Cancel all tasks
-        for task in list(scheduler.tasks.values()):
-            if not task.done():
-                task.cancel()
+        # Cancel dispatcher and sends
+        registry.close()
+        bot.backups.stop()
+        await scheduler.close()
         # Disconnect clients
-        mtproto_mgr.disconnect_all()
+        await mtproto_mgr.disconnect_all()
+        db.close()
         await bot.disconnect()
         logger.info("Bot to'xtatildi")
 
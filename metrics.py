@@ -0,0 +1,199 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of latency buckets, seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = 'botuser_'
+
+class Histogram:
+    """Counts of observations per latency bucket"""
+    __slots__ = ('counts', 'sum', 'count')
+    
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+    
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+class Registry:
+    """Process-wide counters, latency histograms and gauges"""
+    
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.server = None
+    
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(seconds)
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def gauge(self, name, func):
+        """Register a callback read on every export"""
+        self.gauges[name] = func
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+    
+    def read_gauges(self):
+        values = {}
+        for name, func in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception as e:
+                logger.error(f"Gauge {name} error: {e}")
+        return values
+    
+    def render(self):
+        """Prometheus text exposition format"""
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            
+            lines = []
+            typed = set()
+            for (name, labels), hist in histograms:
+                if name not in typed:
+                    lines.append(f'# TYPE {PREFIX}{name} histogram')
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += count
+                    lines.append(f'{PREFIX}{name}_bucket{label_text(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{PREFIX}{name}_sum{label_text(labels)} {hist.sum:.6f}')
+                lines.append(f'{PREFIX}{name}_count{label_text(labels)} {hist.count}')
+            
+            for (name, labels), value in counters:
+                if name not in typed:
+                    lines.append(f'# TYPE {PREFIX}{name} counter')
+                    typed.add(name)
+                lines.append(f'{PREFIX}{name}{label_text(labels)} {value}')
+        
+        for name, value in sorted(self.read_gauges().items()):
+            lines.append(f'# TYPE {PREFIX}{name} gauge')
+            lines.append(f'{PREFIX}{name} {value}')
+        return '\n'.join(lines) + '\n'
+    
+    def snapshot(self):
+        """Raw numbers as plain lists, so other processes can add them up"""
+        with self.lock:
+            histograms = [
+                [name, labels, list(hist.counts), hist.sum, hist.count]
+                for (name, labels), hist in self.histograms.items()
+            ]
+            counters = [[name, labels, value] for (name, labels), value in self.counters.items()]
+        return {'histograms': histograms, 'counters': counters, 'gauges': self.read_gauges()}
+    
+    def summary(self, others=()):
+        """Short human readable report for the admin, snapshots of other processes added in"""
+        histograms = {}
+        counters = {}
+        gauges = {}
+        for snapshot in [self.snapshot(), *others]:
+            for name, labels, counts, total, count in snapshot['histograms']:
+                hist = histograms.setdefault((name, tuple(map(tuple, labels))), Histogram())
+                hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+                hist.sum += total
+                hist.count += count
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, value in snapshot['gauges'].items():
+                if name.endswith('_max'):
+                    # Maximums of processes can not be added up
+                    gauges[name] = max(gauges.get(name, 0), value)
+                else:
+                    gauges[name] = gauges.get(name, 0) + value
+        
+        lines = ["⏱ Kechikishlar (n, o'rtacha, p95):"]
+        for (name, labels), hist in sorted(histograms.items()):
+            avg = hist.sum / hist.count * 1000
+            p95 = hist.quantile(0.95) * 1000
+            lines.append(f"{name}{label_text(labels)}: {hist.count}, {avg:.1f} ms, ≤{p95:g} ms")
+        
+        lines.append("\n🔢 Hisoblagichlar:")
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"{name}{label_text(labels)}: {value:g}")
+        
+        lines.append("\n📊 Holat:")
+        for name, value in sorted(gauges.items()):
+            lines.append(f"{name}: {value}")
+        return '\n'.join(lines)
+    
+    async def handle_http(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1] == '/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Metrics request error: {e}")
+        finally:
+            writer.close()
+    
+    async def serve(self, port, host='127.0.0.1'):
+        """Start local endpoint for Prometheus scraping"""
+        self.server = await asyncio.start_server(self.handle_http, host, port)
+        logger.info(f"Metrics on http://{host}:{port}/metrics")
+    
+    def close(self):
+        if self.server:
+            self.server.close()
+
+registry = Registry()
@@ -1,16 +1,74 @@
+import asyncio
+import logging
 import os
-from telethon import TelegramClient
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from telethon import TelegramClient, utils
+from telethon.errors import FileReferenceExpiredError, FileReferenceInvalidError
 from telethon.sessions import StringSession
-from config import API_ID, API_HASH, SESSION_DIR
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser, InputPhoto
+from config import (
+    API_ID, API_HASH, SESSION_DIR, WARMUP_CONCURRENCY, WARMUP_RATE,
+    MAX_CLIENTS, CLIENT_IDLE_TIMEOUT
+)
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+def process_rss():
+    """Resident memory of the process in bytes, 0 if unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def split_input_peer(peer):
+    """InputPeer as (peer_type, peer_id, access_hash) for storage"""
+    if isinstance(peer, InputPeerChannel):
+        return 'channel', peer.channel_id, peer.access_hash
+    if isinstance(peer, InputPeerChat):
+        return 'chat', peer.chat_id, None
+    if isinstance(peer, InputPeerUser):
+        return 'user', peer.user_id, peer.access_hash
+    raise ValueError(f"Unsupported peer {type(peer).__name__}")
+
+def build_input_peer(peer_type, peer_id, access_hash):
+    if peer_type == 'channel':
+        return InputPeerChannel(peer_id, access_hash)
+    if peer_type == 'chat':
+        return InputPeerChat(peer_id)
+    return InputPeerUser(peer_id, access_hash)
+
+class SessionExpiredError(Exception):
+    pass
 
 class MTProtoManager:
-    def __init__(self):
-        self.clients = {}
+    def __init__(self, db=None, max_clients=MAX_CLIENTS, idle_timeout=CLIENT_IDLE_TIMEOUT, client_cls=TelegramClient):
+        self.db = db
+        self.client_cls = client_cls
+        self.peers = {}
+        self.photos = {}
+        # One upload per advert photo, other targets wait for its InputPhoto
+        self.uploads = {}
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.clients = OrderedDict()
+        self.last_used = {}
+        self.leases = {}
+        self.connecting = {}
+        # Connects in flight that already took a place in the pool
+        self.reserved = 0
+        self.counters = {'hits': 0, 'connects': 0, 'evictions': 0, 'idle_disconnects': 0}
+        self.reaper = None
+        self.warming = set()
+        self.warmup_stats = {}
     
     async def create_client(self, user_id):
         """Create new MTProto client for login"""
         session = StringSession()
-        client = TelegramClient(session, API_ID, API_HASH)
+        client = self.client_cls(session, API_ID, API_HASH)
         return client
     
     def save_session(self, user_id, client):
@@ -23,39 +81,280 @@ class MTProtoManager:
         if user_id in self.clients:
             return self.clients[user_id]
         
-        session = StringSession(session_string)
-        client = TelegramClient(session, API_ID, API_HASH)
-        await client.connect()
+        # Concurrent callers share one connection attempt
+        task = self.connecting.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._connect(user_id, session_string))
+            task.add_done_callback(lambda t: self.connecting.pop(user_id, None))
+            self.connecting[user_id] = task
+        return await asyncio.shield(task)
+    
+    async def _connect(self, user_id, session_string):
+        """Connect client and put it into the pool"""
+        await self.make_room()
+        self.reserved += 1
+        try:
+            session = StringSession(session_string)
+            client = self.client_cls(session, API_ID, API_HASH)
+            with registry.timer('mtproto_connect_seconds'):
+                await client.connect()
+            
+            with registry.timer('mtproto_auth_seconds'):
+                authorized = await client.is_user_authorized()
+            if not authorized:
+                await client.disconnect()
+                registry.inc('mtproto_connects_total', result='expired')
+                raise SessionExpiredError("Session expired")
+            
+            registry.inc('mtproto_connects_total', result='ok')
+            self.counters['connects'] += 1
+            self.add(user_id, client)
+            return client
+        finally:
+            self.reserved -= 1
+    
+    def add(self, user_id, client):
+        """Put connected client into the pool as most recently used"""
+        self.clients[user_id] = client
+        self.clients.move_to_end(user_id)
+        self.last_used[user_id] = time.monotonic()
+    
+    async def adopt(self, user_id, client):
+        """Take over an authorized login client instead of reconnecting later"""
+        for key in [k for k in self.peers if k[0] == user_id]:
+            del self.peers[key]
+        for key in [k for k in self.photos if k[0] == user_id]:
+            del self.photos[key]
+        old = self.clients.get(user_id)
+        if old is client:
+            return
+        if old is not None:
+            await self.release(user_id)
+        await self.make_room()
+        self.warming.discard(user_id)
+        self.add(user_id, client)
+    
+    async def make_room(self):
+        """Evict least recently used idle clients while the pool is full"""
+        for user_id in list(self.clients):
+            if len(self.clients) + self.reserved < self.max_clients:
+                return
+            if self.leases.get(user_id):
+                continue
+            self.counters['evictions'] += 1
+            await self.release(user_id)
         
-        if not await client.is_user_authorized():
-            raise Exception("Session expired")
+        if len(self.clients) + self.reserved >= self.max_clients:
+            logger.warning(f"Client pool over limit: {len(self.clients)} clients in use")
+    
+    async def release(self, user_id):
+        """Disconnect pooled client, it reconnects on next use"""
+        client = self.clients.pop(user_id, None)
+        self.last_used.pop(user_id, None)
+        if client:
+            try:
+                await client.disconnect()
+            except Exception as e:
+                logger.error(f"Disconnect error for user {user_id}: {e}")
+    
+    async def reap_idle(self):
+        """Disconnect clients unused for longer than idle timeout"""
+        deadline = time.monotonic() - self.idle_timeout
+        for user_id in list(self.clients):
+            if self.last_used.get(user_id, 0) < deadline and not self.leases.get(user_id):
+                self.counters['idle_disconnects'] += 1
+                await self.release(user_id)
+    
+    async def reaper_loop(self):
+        """Periodically drop idle clients"""
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 60))
+            try:
+                await self.reap_idle()
+            except Exception as e:
+                logger.error(f"Client reaper error: {e}")
+    
+    def start_reaper(self):
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.create_task(self.reaper_loop())
+    
+    def is_warming(self, user_id):
+        """Check if session is still waiting for warm-up"""
+        return user_id in self.warming
+    
+    async def warm_up(self, users, concurrency=WARMUP_CONCURRENCY, rate=WARMUP_RATE):
+        """Connect and authorize sessions in parallel with bounded concurrency and rate"""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        next_start = start
+        # More sessions than the pool holds would only evict each other,
+        # the rest connect on their first send
+        room = max(0, self.max_clients - len(self.clients) - self.reserved)
+        results = {u['user_id']: 'deferred' for u in users[room:]}
+        users = users[:room]
+        pending = iter(users)
+        self.warming.update(u['user_id'] for u in users)
         
-        self.clients[user_id] = client
-        return client
+        async def worker():
+            nonlocal next_start
+            for user in pending:
+                user_id = user['user_id']
+                now = loop.time()
+                delay = next_start - now
+                next_start = max(now, next_start) + 1 / rate
+                try:
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    await self.load_client(user_id, user['session_string'])
+                    results[user_id] = 'ok'
+                except SessionExpiredError:
+                    results[user_id] = 'expired'
+                except Exception as e:
+                    logger.error(f"Warm-up error for user {user_id}: {e}")
+                    results[user_id] = 'error'
+                finally:
+                    self.warming.discard(user_id)
+        
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(users)) or 1)))
+        
+        outcomes = list(results.values())
+        self.warmup_stats = {
+            'total': len(outcomes),
+            'ok': outcomes.count('ok'),
+            'expired': outcomes.count('expired'),
+            'error': outcomes.count('error'),
+            'deferred': outcomes.count('deferred'),
+            'seconds': round(loop.time() - start, 2),
+        }
+        return results
     
-    def delete_session(self, user_id):
-        """Delete session and disconnect client"""
-        if user_id in self.clients:
-            client = self.clients[user_id]
+    async def get_input_peer(self, user_id, client, chat_id):
+        """InputPeer of chat for user's account, resolved once and persisted"""
+        key = (user_id, chat_id)
+        peer = self.peers.get(key)
+        if peer is not None:
+            return peer
+        
+        if self.db is not None:
+            row = await self.db.get_peer(user_id, chat_id)
+            if row:
+                peer = self.peers[key] = build_input_peer(*row)
+                return peer
+        
+        try:
+            peer = await client.get_input_entity(chat_id)
+        except ValueError:
+            # Fresh StringSession has no entities yet, dialogs fill the cache
+            await client.get_dialogs()
+            peer = await client.get_input_entity(chat_id)
+        
+        self.peers[key] = peer
+        if self.db is not None:
+            await self.db.save_peer(user_id, chat_id, *split_input_peer(peer))
+        return peer
+    
+    async def forget_peer(self, user_id, chat_id):
+        """Drop cached peer that stopped working"""
+        self.peers.pop((user_id, chat_id), None)
+        if self.db is not None:
+            await self.db.delete_peers(chat_id=chat_id, user_id=user_id)
+    
+    async def get_photo(self, user_id, media_path):
+        """Already uploaded photo of user's advert, None if it must be uploaded"""
+        photo = self.photos.get((user_id, media_path))
+        if photo is None and self.db is not None:
+            row = await self.db.get_media(user_id, media_path)
+            if row:
+                photo = self.photos[(user_id, media_path)] = InputPhoto(*row)
+        return photo
+    
+    async def forget_photo(self, user_id):
+        for key in [k for k in self.photos if k[0] == user_id]:
+            del self.photos[key]
+        if self.db is not None:
+            await self.db.delete_media(user_id)
+    
+    async def send_advert(self, user_id, client, peer, text, media_path=None, entities=()):
+        """Send advert with pre-parsed entities, uploading its photo only once per account"""
+        entities = list(entities)
+        if not media_path:
+            return await client.send_message(peer, text, formatting_entities=entities)
+        
+        photo = await self.get_photo(user_id, media_path)
+        if photo is not None:
             try:
-                client.disconnect()
-            except:
-                pass
-            del self.clients[user_id]
+                return await client.send_file(peer, photo, caption=text, formatting_entities=entities)
+            except (FileReferenceExpiredError, FileReferenceInvalidError):
+                logger.info(f"Photo reference expired for user {user_id}, uploading again")
+                await self.forget_photo(user_id)
+        
+        key = (user_id, media_path)
+        lock = self.uploads.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Another target may have uploaded it while we waited
+            fresh = self.photos.get(key)
+            if fresh is not None and fresh is not photo:
+                return await client.send_file(peer, fresh, caption=text, formatting_entities=entities)
+            
+            message = await client.send_file(peer, media_path, caption=text, formatting_entities=entities)
+            photo = utils.get_input_photo(message.media.photo)
+            self.photos[key] = photo
+            if self.db is not None:
+                await self.db.save_media(user_id, media_path, photo.id, photo.access_hash, photo.file_reference)
+        return message
+    
+    def on_setting(self, key, value):
+        """Target group changed, resolved peers are not needed anymore"""
+        if key == 'target_group':
+            self.peers.clear()
+    
+    async def delete_session(self, user_id):
+        """Delete session and disconnect client"""
+        await self.release(user_id)
+        for key in [k for k in self.peers if k[0] == user_id]:
+            del self.peers[key]
+        for key in [k for k in self.photos if k[0] == user_id]:
+            del self.photos[key]
+        for key in [k for k in self.uploads if k[0] == user_id]:
+            del self.uploads[key]
     
     async def get_client(self, user_id, session_string):
-        """Get or create client"""
-        if user_id in self.clients:
-            return self.clients[user_id]
+        """Get pooled client, reconnecting if it was evicted"""
+        client = self.clients.get(user_id)
+        if client is not None:
+            if client.is_connected():
+                self.counters['hits'] += 1
+                self.add(user_id, client)
+                return client
+            await self.release(user_id)
         return await self.load_client(user_id, session_string)
     
-    def disconnect_all(self):
+    @asynccontextmanager
+    async def lease(self, user_id, session_string):
+        """Get client and protect it from eviction while in use"""
+        self.leases[user_id] = self.leases.get(user_id, 0) + 1
+        try:
+            yield await self.get_client(user_id, session_string)
+        finally:
+            self.leases[user_id] -= 1
+            if not self.leases[user_id]:
+                del self.leases[user_id]
+            if user_id in self.clients:
+                self.last_used[user_id] = time.monotonic()
+    
+    def stats(self):
+        """Pool size, counters and process memory"""
+        return {
+            'live': len(self.clients),
+            'max': self.max_clients,
+            'leased': len(self.leases),
+            **self.counters,
+            'rss_bytes': process_rss(),
+        }
+    
+    async def disconnect_all(self):
         """Disconnect all clients"""
+        if self.reaper and not self.reaper.done():
+            self.reaper.cancel()
         for user_id in list(self.clients.keys()):
-            try:
-                client = self.clients[user_id]
-                if client.is_connected():
-                    client.disconnect()
-            except Exception:
-                pass
-        self.clients.clear()
\ No newline at end of file
+            await self.release(user_id)
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from config import TARGET_RATE, TARGET_BURST
+
+class TokenBucket:
+    """Token bucket where callers wait their turn in FIFO order"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.queued = 0
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self):
+        """Wait for one token, returns seconds waited"""
+        start = time.monotonic()
+        self.queued += 1
+        try:
+            async with self.lock:
+                self.refill()
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    self.refill()
+                self.tokens -= 1
+        finally:
+            self.queued -= 1
+        
+        waited = time.monotonic() - start
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return waited
+    
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'acquired': self.acquired,
+            'wait_avg': round(self.wait_total / self.acquired, 3) if self.acquired else 0.0,
+            'wait_max': round(self.wait_max, 3),
+        }
+
+class TargetLimiter:
+    """One shared token bucket per target chat"""
+    
+    def __init__(self, rate=TARGET_RATE, burst=TARGET_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+    
+    async def acquire(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(self.rate, self.burst)
+        return await bucket.acquire()
+    
+    def queue_depth(self):
+        return sum(b.queued for b in self.buckets.values())
+    
+    def acquired(self):
+        return sum(b.acquired for b in self.buckets.values())
+    
+    def wait_total(self):
+        """Seconds waited for tokens over all targets"""
+        return round(sum(b.wait_total for b in self.buckets.values()), 3)
+    
+    def wait_max(self):
+        return round(max((b.wait_max for b in self.buckets.values()), default=0.0), 3)
+    
+    def stats(self):
+        return {chat_id: bucket.stats() for chat_id, bucket in self.buckets.items()}
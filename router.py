@@ -0,0 +1,97 @@
+import inspect
+import logging
+import re
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class Latency:
+    """Durations of recent handler calls"""
+    
+    def __init__(self, window=1000, slow=1.0):
+        self.samples = deque(maxlen=window)
+        self.slow = slow
+        self.count = 0
+        self.max = 0.0
+    
+    def add(self, seconds, name):
+        self.samples.append(seconds)
+        self.count += 1
+        self.max = max(self.max, seconds)
+        if seconds > self.slow:
+            logger.warning(f"Slow handler {name}: {seconds:.2f}s")
+    
+    def stats(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': 0, 'avg_ms': 0, 'p95_ms': 0, 'max_ms': 0}
+        return {
+            'count': self.count,
+            'avg_ms': round(sum(samples) / len(samples) * 1000),
+            'p95_ms': round(samples[int(len(samples) * 0.95)] * 1000),
+            'max_ms': round(self.max * 1000),
+        }
+
+class Route:
+    """Handler of one callback key and the shape of its ':' argument"""
+    __slots__ = ('handler', 'pattern', 'required')
+    
+    def __init__(self, handler, arg=None):
+        self.handler = handler
+        self.pattern = re.compile(arg) if arg else None
+        params = list(inspect.signature(handler).parameters.values())[1:]
+        self.required = bool(params) and params[0].default is inspect.Parameter.empty
+    
+    def accepts(self, sep, arg):
+        if not sep:
+            return not self.required
+        return self.pattern is not None and self.pattern.fullmatch(arg) is not None
+
+class CallbackRouter:
+    """Dispatch callback queries by exact data with an optional ':' argument"""
+    
+    def __init__(self):
+        self.routes = {}
+        self.latency = Latency()
+    
+    def add(self, data, handler, arg=None):
+        """Register handler, arg is a regex the ':' argument must match"""
+        if data in self.routes:
+            raise ValueError(f"Route {data!r} already registered")
+        self.routes[data] = Route(handler, arg)
+    
+    async def dispatch(self, event):
+        key, sep, arg = event.data.partition(b':')
+        route = self.routes.get(key)
+        if route is None:
+            logger.warning(f"Unknown callback {event.data!r} from {event.sender_id}")
+            await event.answer()
+            return
+        
+        # Callback data comes from the client and can be forged
+        arg = arg.decode(errors='replace')
+        if not route.accepts(sep, arg):
+            logger.warning(f"Malformed callback {event.data!r} from {event.sender_id}")
+            await event.answer()
+            return
+        
+        handler = route.handler
+        start = time.perf_counter()
+        try:
+            if sep:
+                await handler(event, arg)
+            else:
+                await handler(event)
+        finally:
+            self.latency.add(time.perf_counter() - start, key.decode())
+    
+    def timed(self, handler):
+        """Wrap a message handler to count it in the same latency stats"""
+        async def wrapper(event):
+            start = time.perf_counter()
+            try:
+                await handler(event)
+            finally:
+                self.latency.add(time.perf_counter() - start, handler.__name__)
+        return wrapper
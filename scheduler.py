@@ -1,114 +1,525 @@
 import asyncio
+import heapq
+import itertools
 import logging
-from telethon.errors import FloodWaitError, UserBannedInChannelError
+import math
+import random
+import time
+from telethon.errors import (
+    FloodWaitError, UserBannedInChannelError, ChatWriteForbiddenError,
+    PeerIdInvalidError, ChannelInvalidError, ChannelPrivateError
+)
+from config import (
+    DEFAULT_INTERVAL, SEND_JITTER, WARMUP_DEFER, TARGET_RATE, TARGET_BURST,
+    FLOOD_PACE_STEP, FLOOD_PACE_MAX, FLOOD_PACE_DECAY,
+    ACCOUNT_FANOUT, SEND_TIMEOUT, SEND_MAX_LAG
+)
+from mtproto import SessionExpiredError
+from ratelimit import TargetLimiter
+from sendpool import SendPool
+from sendlog import SendLog
+from metrics import registry
+from db import shard_of
 
 logger = logging.getLogger(__name__)
 
+PEER_ERRORS = (ValueError, PeerIdInvalidError, ChannelInvalidError, ChannelPrivateError)
+BANNED_ERRORS = (UserBannedInChannelError, ChatWriteForbiddenError, ChannelPrivateError)
+
+def phase_offset(user_id, interval):
+    """Stable position of user inside the interval"""
+    return (user_id * 2654435761 % 2**32) / 2**32 * interval
+
+def next_slot(user_id, interval, after):
+    """First phase-aligned send time of user not earlier than after"""
+    phase = phase_offset(user_id, interval)
+    return phase + math.ceil((after - phase) / interval) * interval
+
+def send_jitter(interval):
+    """Random shift of a single send around its slot"""
+    spread = min(SEND_JITTER, interval / 4)
+    return random.uniform(-spread, spread)
+
+def send_outcome(error):
+    """Outcome class of a failed send for the delivery log"""
+    if isinstance(error, FloodWaitError):
+        return 'flood'
+    if isinstance(error, BANNED_ERRORS):
+        return 'banned'
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    return 'error'
+
+class SendEntry:
+    """Timer heap entry of one active sender"""
+    __slots__ = ('user_id', 'slot', 'due', 'pace', 'last', 'cancelled')
+    
+    def __init__(self, user_id, slot, due, pace=1.0):
+        self.user_id = user_id
+        self.slot = slot
+        self.due = due
+        self.pace = pace
+        self.last = None
+        self.cancelled = False
+
 class Scheduler:
-    def __init__(self, bot, db, mtproto_mgr):
+    def __init__(self, bot, db, mtproto_mgr, shard=None):
         self.bot = bot
         self.db = db
         self.mtproto_mgr = mtproto_mgr
-        self.tasks = {}
+        # (index, count) when running as one of several sender processes
+        self.shard = shard
+        self.interval = DEFAULT_INTERVAL
+        self.heap = []
+        self.entries = {}
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+        self.warmup = None
+        if shard:
+            # Every shard sends into the same groups, split the group budget
+            self.limiter = TargetLimiter(TARGET_RATE / shard[1], max(1, TARGET_BURST // shard[1]))
+        else:
+            self.limiter = TargetLimiter()
+        self.pool = SendPool(self.run_send)
+        self.send_log = SendLog(db)
     
     async def send_message_once(self, user_id):
-        """Send message once to target group"""
+        """Send message once to every target group of user"""
+        start = time.perf_counter()
         try:
-            user = self.db.get_user(user_id)
+            user = await self.db.get_record(user_id)
             if not user:
                 logger.error(f"User {user_id} not found")
                 return False
             
-            message_text = self.db.get_message(user_id)
-            if not message_text:
+            if user.message_text is None:
                 logger.error(f"No message for user {user_id}")
                 return False
             
-            target_group = self.db.get_target_group()
-            if not target_group:
-                logger.error("No target group set")
+            own_targets = user.has_own_targets
+            targets = list(user.targets)
+            if own_targets and not targets:
+                # Never move a user's advert to the global group behind their back
+                logger.warning(f"All target groups of user {user_id} are disabled, stopping sender")
+                await self.stop_sender(user_id)
                 return False
+            if not targets:
+                target_group = await self.db.get_target_group()
+                if not target_group:
+                    logger.error("No target group set")
+                    return False
+                targets = [target_group]
             
-            client = await self.mtproto_mgr.get_client(user_id, user['session_string'])
+            limit = time.perf_counter()
+            registry.observe('send_phase_seconds', limit - start, phase='db')
+            # Tokens first, so no client is leased while waiting in the bucket
+            targets = await self.acquire_targets(user_id, targets)
+            if not targets:
+                return False
+            acquire = time.perf_counter()
+            registry.observe('send_phase_seconds', acquire - limit, phase='limit')
+            async with self.mtproto_mgr.lease(user_id, user.session_string) as client:
+                registry.observe('send_phase_seconds', time.perf_counter() - acquire, phase='client')
+                fanout = asyncio.Semaphore(ACCOUNT_FANOUT)
+                results = await asyncio.gather(
+                    *(self.send_to_target(user, client, chat_id, fanout) for chat_id in targets),
+                    return_exceptions=True
+                )
             
-            await client.send_message(target_group, message_text)
-            logger.info(f"Message sent by user {user_id}")
-            return True
+            floods = [r.seconds for r in results if isinstance(r, FloodWaitError)]
+            if floods:
+                await self.flood_backoff(user_id, max(floods))
             
-        except FloodWaitError as e:
-            logger.warning(f"FloodWait {e.seconds}s for user {user_id}")
-            await asyncio.sleep(e.seconds)
-            return False
+            for chat_id, result in zip(targets, results):
+                await self.track_target(user, chat_id, result, own_targets)
+            
+            sent = sum(1 for r in results if r is True)
+            registry.observe('send_seconds', time.perf_counter() - start)
+            logger.info(f"Message sent by user {user_id} to {sent}/{len(targets)} groups")
+            
+            if sent and not floods and user.pace > 1:
+                pace = max(1.0, user.pace * FLOOD_PACE_DECAY)
+                await self.db.set_backoff(user_id, 0, pace)
+                self.set_pace(user_id, pace)
+            return sent > 0
         
-        except UserBannedInChannelError:
-            logger.error(f"User {user_id} banned in channel")
-            self.stop_sender(user_id)
+        except SessionExpiredError:
+            logger.error(f"Session expired for user {user_id}")
+            await self.db.set_session_expired(user_id, True)
+            await self.stop_sender(user_id)
             return False
         
         except Exception as e:
             logger.error(f"Send error for user {user_id}: {e}")
             return False
     
-    async def sender_loop(self, user_id):
-        """Main sending loop for a user"""
-        logger.info(f"Starting sender loop for user {user_id}")
+    async def acquire_targets(self, user_id, targets):
+        """Take a rate limit token per target, skip targets not served within SEND_MAX_LAG"""
+        waits = await asyncio.gather(
+            *(asyncio.wait_for(self.limiter.acquire(chat_id), SEND_MAX_LAG) for chat_id in targets),
+            return_exceptions=True
+        )
+        ready = []
+        for chat_id, wait in zip(targets, waits):
+            if isinstance(wait, asyncio.TimeoutError):
+                logger.warning(f"Rate limit wait of user {user_id} for {chat_id} ran out, target skipped")
+                self.send_log.add(user_id, chat_id, 'throttled', SEND_MAX_LAG, 'TimeoutError')
+                registry.inc('sends_total', outcome='throttled')
+            elif isinstance(wait, BaseException):
+                raise wait
+            else:
+                ready.append(chat_id)
+        return ready
+    
+    async def send_to_target(self, user, client, chat_id, fanout):
+        """Send advert of user to one group, its rate limit token is already taken"""
+        async with fanout:
+            start = time.monotonic()
+            try:
+                peer = await self.mtproto_mgr.get_input_peer(user.user_id, client, chat_id)
+                await asyncio.wait_for(
+                    self.mtproto_mgr.send_advert(
+                        user.user_id, client, peer, user.message_text, user.media_path, user.entities
+                    ),
+                    SEND_TIMEOUT
+                )
+            except Exception as e:
+                latency = time.monotonic() - start
+                outcome = send_outcome(e)
+                self.send_log.add(user.user_id, chat_id, outcome, latency, type(e).__name__)
+                registry.observe('send_phase_seconds', latency, phase='rpc')
+                registry.inc('sends_total', outcome=outcome)
+                if isinstance(e, PEER_ERRORS):
+                    await self.mtproto_mgr.forget_peer(user.user_id, chat_id)
+                raise
+        latency = time.monotonic() - start
+        self.send_log.add(user.user_id, chat_id, 'ok', latency)
+        registry.observe('send_phase_seconds', latency, phase='rpc')
+        registry.inc('sends_total', outcome='ok')
+        return True
+    
+    async def track_target(self, user, chat_id, result, own_target):
+        """Record outcome of one target, ban stops only that target"""
+        user_id = user.user_id
+        if result is True:
+            if own_target and user.targets.get(chat_id):
+                await self.db.record_target_result(user_id, chat_id)
+            return
+        
+        if isinstance(result, FloodWaitError):
+            return
         
-        # Send immediately on start
-        await self.send_message_once(user_id)
+        error = type(result).__name__
+        if isinstance(result, BANNED_ERRORS):
+            logger.error(f"User {user_id} can not post to {chat_id}: {error}")
+            if own_target:
+                await self.db.record_target_result(user_id, chat_id, error, disable=True)
+            else:
+                await self.stop_sender(user_id)
+            return
         
-        while self.db.is_sending_active(user_id):
+        logger.error(f"Send error for user {user_id} to {chat_id}: {error} {result}")
+        if own_target:
+            await self.db.record_target_result(user_id, chat_id, error)
+    
+    async def flood_backoff(self, user_id, seconds):
+        """Remember FloodWait deadline and widen pace of the account"""
+        user = await self.db.get_record(user_id)
+        pace = min(FLOOD_PACE_MAX, (user.pace if user else 1.0) * FLOOD_PACE_STEP)
+        until = time.time() + seconds
+        logger.warning(f"FloodWait {seconds}s for user {user_id}, pace x{pace:.2f}")
+        registry.inc('flood_waits_total')
+        registry.inc('flood_wait_seconds_total', seconds)
+        
+        await self.db.set_backoff(user_id, until, pace)
+        if user_id in self.entries:
+            self.schedule(user_id, self.slot_after(user_id, until, pace), pace=pace)
+    
+    def set_pace(self, user_id, pace):
+        """Move running sender onto the grid of its new interval multiplier"""
+        entry = self.entries.get(user_id)
+        if not entry or entry.pace == pace:
+            return
+        interval = self.interval * pace
+        after = time.time() if entry.last is None else max(time.time(), entry.last + interval / 2)
+        last = entry.last
+        self.schedule(user_id, self.slot_after(user_id, after, pace), pace=pace)
+        self.entries[user_id].last = last
+    
+    async def dispatch_loop(self):
+        """Fire due senders from the timer heap"""
+        while True:
             try:
-                interval = self.db.get_interval()
-                await asyncio.sleep(interval)
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                
+                now = time.time()
+                timeout = self.heap[0][0] - now if self.heap else None
+                if timeout is None or timeout > 0:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                
+                due, _, entry = heapq.heappop(self.heap)
+                if self.mtproto_mgr.is_warming(entry.user_id):
+                    entry.due = now + WARMUP_DEFER
+                    heapq.heappush(self.heap, (entry.due, next(self.seq), entry))
+                    continue
                 
-                if not self.db.is_sending_active(user_id):
-                    break
+                interval = self.interval * entry.pace
+                entry.last = now
+                entry.slot += interval
+                if entry.slot <= now:
+                    entry.slot = self.slot_after(entry.user_id, now + interval / 2, entry.pace)
+                entry.due = entry.slot + send_jitter(interval)
+                heapq.heappush(self.heap, (entry.due, next(self.seq), entry))
                 
-                await self.send_message_once(user_id)
+                self.pool.submit(entry.user_id, due)
+                # Let button handlers run between bursts of due ticks
+                await asyncio.sleep(0)
             except asyncio.CancelledError:
-                logger.info(f"Sender loop cancelled for user {user_id}")
-                break
+                logger.info("Dispatcher cancelled")
+                raise
             except Exception as e:
-                logger.error(f"Sender loop error for user {user_id}: {e}")
-                await asyncio.sleep(60)  # Wait 1 min before retry
+                logger.error(f"Dispatcher error: {e}")
+                await asyncio.sleep(1)
+    
+    async def run_send(self, user_id):
+        """Send of a queued tick, skipped if sender was stopped meanwhile"""
+        if user_id in self.entries:
+            await self.send_message_once(user_id)
+    
+    def slot_after(self, user_id, after, pace=1.0):
+        """Next phase-aligned send time of user on its paced interval"""
+        return next_slot(user_id, self.interval * pace, after)
+    
+    def schedule(self, user_id, slot, due=None, pace=1.0):
+        """Put user into timer heap, replacing previous entry"""
+        old = self.entries.get(user_id)
+        if old:
+            old.cancelled = True
         
-        logger.info(f"Sender loop stopped for user {user_id}")
+        if due is None:
+            due = slot + send_jitter(self.interval * pace)
+        entry = SendEntry(user_id, slot, due, pace)
+        self.entries[user_id] = entry
+        heapq.heappush(self.heap, (due, next(self.seq), entry))
+        
+        if self.heap[0][2] is entry:
+            self.wakeup.set()
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch_loop())
+    
+    def unschedule(self, user_id):
+        """Drop user from timer heap"""
+        entry = self.entries.pop(user_id, None)
+        if entry:
+            entry.cancelled = True
+        return entry is not None
     
-    def start_sender(self, user_id):
-        """Start sending loop for user"""
-        if user_id in self.tasks and not self.tasks[user_id].done():
+    async def start_sender(self, user_id):
+        """Start sending for user"""
+        if user_id in self.entries:
             logger.info(f"Sender already running for user {user_id}")
             return
         
-        self.db.set_sending_active(user_id, True)
-        task = asyncio.create_task(self.sender_loop(user_id))
-        self.tasks[user_id] = task
+        await self.db.set_sending_active(user_id, True)
+        record = await self.db.get_record(user_id)
+        pace = record.pace if record else 1.0
+        
+        now = time.time()
+        last_ok = await self.send_log.last_success(user_id)
+        if record and record.flood_until > now:
+            # Still flood-limited, wait for the penalty to pass
+            self.schedule(user_id, self.slot_after(user_id, record.flood_until, pace), pace=pace)
+        elif last_ok and now - last_ok < self.interval * pace / 2:
+            # Sent moments ago, a quick stop/start should not post again
+            self.schedule(user_id, self.slot_after(user_id, last_ok + self.interval * pace / 2, pace), pace=pace)
+        else:
+            # Send right away in place of the previous grid point, the dispatcher
+            # then advances to the user's next phase slot
+            interval = self.interval * pace
+            slot = self.slot_after(user_id, now + interval / 2, pace)
+            self.schedule(user_id, slot - interval, now, pace)
         logger.info(f"Started sender for user {user_id}")
     
-    def stop_sender(self, user_id):
-        """Stop sending loop for user"""
-        self.db.set_sending_active(user_id, False)
+    async def stop_sender(self, user_id):
+        """Stop sending for user"""
+        await self.db.set_sending_active(user_id, False)
+        self.unschedule(user_id)
+        logger.info(f"Stopped sender for user {user_id}")
+    
+    async def start_many(self, user_ids):
+        """Start sending for many users at once, returns outcome per user"""
+        outcomes = {}
+        ready = []
+        for user_id in user_ids:
+            record = await self.db.get_record(user_id)
+            if user_id in self.entries:
+                outcomes[user_id] = 'already_running'
+            elif not record:
+                outcomes[user_id] = 'no_user'
+            elif record.session_expired:
+                outcomes[user_id] = 'expired'
+            elif record.message_text is None:
+                outcomes[user_id] = 'no_message'
+            elif record.has_own_targets and not record.targets:
+                outcomes[user_id] = 'no_targets'
+            else:
+                outcomes[user_id] = 'started'
+                ready.append(user_id)
         
-        if user_id in self.tasks:
-            task = self.tasks[user_id]
-            if not task.done():
-                task.cancel()
-            del self.tasks[user_id]
+        if ready:
+            await self.db.set_sending_active_many(ready, True)
+            # Bulk starts join their phase instead of sending all at once
+            now = time.time()
+            for user_id in ready:
+                await self.schedule_restored(user_id, now)
         
-        logger.info(f"Stopped sender for user {user_id}")
+        logger.info(f"Bulk start: {len(ready)} of {len(outcomes)} senders started")
+        return outcomes
+    
+    async def stop_all(self):
+        """Stop every active sender, returns outcome per user"""
+        user_ids = await self.db.deactivate_all()
+        outcomes = {user_id: 'stopped' for user_id in user_ids}
+        for user_id in list(self.entries):
+            self.unschedule(user_id)
+            outcomes.setdefault(user_id, 'stopped')
+        
+        logger.info(f"Bulk stop: {len(outcomes)} senders stopped")
+        return outcomes
+    
+    def on_setting(self, key, value):
+        """React to settings changed by admin"""
+        if key == 'interval':
+            self.apply_interval(int(value))
+    
+    def apply_interval(self, seconds):
+        """Move pending deadlines to the new interval"""
+        if seconds == self.interval:
+            return
+        self.interval = seconds
+        
+        now = time.time()
+        self.heap = []
+        for entry in self.entries.values():
+            interval = seconds * entry.pace
+            after = now if entry.last is None else max(now, entry.last + interval / 2)
+            if entry.due > now:
+                entry.slot = self.slot_after(entry.user_id, after, entry.pace)
+                entry.due = entry.slot + send_jitter(interval)
+            self.heap.append((entry.due, next(self.seq), entry))
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+        logger.info(f"Interval changed to {seconds}s for {len(self.entries)} senders")
+    
+    async def adopt(self, user_id, client):
+        """Use client of a finished login for sending"""
+        await self.mtproto_mgr.adopt(user_id, client)
+    
+    async def forget_user(self, user_id):
+        """Drop sending state kept in memory for a deleted user"""
+        self.send_log.forget(user_id)
     
-    def is_active(self, user_id):
+    async def last_success(self, user_id):
+        return await self.send_log.last_success(user_id)
+    
+    def recent_success(self, user_id):
+        """Last successful send not yet written to the database"""
+        return self.send_log.last_ok.get(user_id)
+    
+    async def status(self):
+        """Pool, send queue and rate limiter numbers for the admin"""
+        return {
+            'senders': len(self.entries),
+            'pool': self.mtproto_mgr.stats(),
+            'sends': self.pool.stats(),
+            'limiter': {str(chat_id): s for chat_id, s in self.limiter.stats().items()},
+        }
+    
+    async def metric_snapshots(self):
+        """Metrics of other sender processes, none when sending runs here"""
+        return []
+    
+    def register_metrics(self):
+        registry.gauge('clients_live', lambda: len(self.mtproto_mgr.clients))
+        registry.gauge('clients_leased', lambda: len(self.mtproto_mgr.leases))
+        registry.gauge('clients_connecting', lambda: len(self.mtproto_mgr.connecting))
+        registry.gauge('senders_scheduled', lambda: len(self.entries))
+        registry.gauge('send_queue', lambda: self.pool.queue.qsize())
+        registry.gauge('send_workers_busy', lambda: len(self.pool.running))
+        registry.gauge('send_log_buffered', lambda: len(self.send_log.buffer))
+        registry.gauge('limiter_targets', lambda: len(self.limiter.buckets))
+        registry.gauge('limiter_queued', self.limiter.queue_depth)
+        registry.gauge('limiter_acquired', self.limiter.acquired)
+        registry.gauge('limiter_wait_seconds', self.limiter.wait_total)
+        registry.gauge('limiter_wait_max', self.limiter.wait_max)
+    
+    async def is_active(self, user_id):
         """Check if sender is active"""
-        return self.db.is_sending_active(user_id)
+        return await self.db.is_sending_active(user_id)
     
-    def get_active_count(self):
+    async def get_active_count(self):
         """Get count of active senders"""
-        return len([u for u in self.db.get_all_users() if self.db.is_sending_active(u['user_id'])])
+        return (await self.db.get_counts())['active']
     
     async def restore_senders(self):
         """Restore active senders after restart"""
-        active_users = self.db.get_active_users()
+        self.interval = await self.db.get_interval()
+        self.send_log.start()
+        loop = asyncio.get_running_loop()
+        self.db.subscribe(lambda key, value, version: loop.call_soon_threadsafe(self.on_setting, key, value))
+        
+        active_users = await self.db.get_active_users()
+        if self.shard:
+            index, count = self.shard
+            active_users = [u for u in active_users if shard_of(u['user_id'], count) == index]
         logger.info(f"Restoring {len(active_users)} active senders")
         
+        now = time.time()
         for user in active_users:
-            self.start_sender(user['user_id'])
\ No newline at end of file
+            await self.schedule_restored(user['user_id'], now)
+        
+        if active_users:
+            self.warmup = asyncio.create_task(self.warm_up(active_users))
+    
+    async def schedule_restored(self, user_id, now):
+        """Schedule user on its phase, honouring stored FloodWait backoff"""
+        record = await self.db.get_record(user_id)
+        pace = record.pace if record else 1.0
+        after = max(now, record.flood_until) if record else now
+        self.schedule(user_id, self.slot_after(user_id, after, pace), pace=pace)
+    
+    async def warm_up(self, users):
+        """Connect restored sessions, stop senders with expired ones"""
+        results = await self.mtproto_mgr.warm_up(users)
+        
+        for user_id, status in results.items():
+            if status == 'expired':
+                logger.warning(f"Session expired for user {user_id}")
+                await self.db.set_session_expired(user_id, True)
+                await self.stop_sender(user_id)
+        
+        stats = self.mtproto_mgr.warmup_stats
+        logger.info(
+            f"Warm-up finished in {stats['seconds']}s: {stats['ok']} ready, "
+            f"{stats['expired']} expired, {stats['error']} failed, "
+            f"{stats['deferred']} left for first send"
+        )
+    
+    async def close(self):
+        """Stop sending and write the rest of the delivery log"""
+        self.stop()
+        await self.send_log.close()
+    
+    def stop(self):
+        """Cancel dispatcher and running sends"""
+        for task in (self.dispatcher, self.warmup):
+            if task and not task.done():
+                task.cancel()
+        self.pool.stop()
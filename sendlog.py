@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from config import SEND_LOG_BATCH, SEND_LOG_FLUSH, SEND_LOG_DAYS
+
+logger = logging.getLogger(__name__)
+
+class SendLog:
+    """Delivery history buffered in memory and written in batches"""
+    
+    def __init__(self, db, batch=SEND_LOG_BATCH, flush_interval=SEND_LOG_FLUSH, keep_days=SEND_LOG_DAYS):
+        self.db = db
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.keep_days = keep_days
+        self.max_buffer = batch * 20
+        self.buffer = []
+        self.last_ok = {}
+        self.full = asyncio.Event()
+        self.flusher = None
+        self.pruned = 0
+        self.counters = {'written': 0, 'flushes': 0, 'dropped': 0, 'errors': 0}
+    
+    def add(self, user_id, chat_id, outcome, latency, error=None):
+        """Queue one send result, never waits for the database"""
+        now = time.time()
+        if len(self.buffer) >= self.max_buffer:
+            # Database is stuck, keep the newest history
+            del self.buffer[:self.batch]
+            self.counters['dropped'] += self.batch
+        self.buffer.append((user_id, chat_id, now, outcome, round(latency, 3), error))
+        if outcome == 'ok':
+            self.last_ok[user_id] = now
+        if len(self.buffer) >= self.batch:
+            self.full.set()
+    
+    async def last_success(self, user_id):
+        """Unix time of last successful send, None if never"""
+        if user_id not in self.last_ok:
+            self.last_ok[user_id] = await self.db.get_last_success(user_id)
+        return self.last_ok[user_id]
+    
+    def forget(self, user_id):
+        self.last_ok.pop(user_id, None)
+    
+    async def flush(self):
+        """Write buffered rows, put them back if the write fails"""
+        if not self.buffer:
+            return
+        rows, self.buffer = self.buffer, []
+        self.full.clear()
+        try:
+            await self.db.add_send_log(rows)
+        except Exception as e:
+            self.counters['errors'] += 1
+            logger.error(f"Send log flush error: {e}")
+            room = max(0, self.max_buffer - len(self.buffer))
+            self.counters['dropped'] += len(rows) - min(room, len(rows))
+            if room:
+                self.buffer[:0] = rows[-room:]
+            return
+        self.counters['written'] += len(rows)
+        self.counters['flushes'] += 1
+    
+    async def prune(self):
+        """Drop history past retention, at most once an hour"""
+        now = time.time()
+        if now - self.pruned < 3600:
+            return
+        self.pruned = now
+        deleted = await self.db.prune_send_log(now - self.keep_days * 86400)
+        if deleted:
+            logger.info(f"Send log: {deleted} old rows removed")
+    
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+                await self.prune()
+            except Exception as e:
+                logger.error(f"Send log error: {e}")
+    
+    def start(self):
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush_loop())
+    
+    async def close(self):
+        """Stop background writes and flush what is left"""
+        if self.flusher and not self.flusher.done():
+            self.flusher.cancel()
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+    
+    def stats(self):
+        return {'buffered': len(self.buffer), **self.counters}
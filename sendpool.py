@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import time
+from config import SEND_WORKERS, SEND_QUEUE_SIZE, SEND_MAX_LAG
+
+logger = logging.getLogger(__name__)
+
+class SendPool:
+    """Fixed number of workers running due sends from a bounded queue"""
+    
+    def __init__(self, handler, workers=SEND_WORKERS, max_queue=SEND_QUEUE_SIZE, max_lag=SEND_MAX_LAG):
+        self.handler = handler
+        self.workers = workers
+        self.max_lag = max_lag
+        self.queue = asyncio.Queue(max_queue)
+        self.pending = set()
+        self.running = {}
+        self.tasks = []
+        self.counters = {'done': 0, 'busy': 0, 'full': 0, 'overdue': 0, 'lag_max': 0.0}
+    
+    def start(self):
+        self.tasks = [t for t in self.tasks if not t.done()]
+        while len(self.tasks) < self.workers:
+            self.tasks.append(asyncio.create_task(self.worker()))
+    
+    def submit(self, user_id, due):
+        """Queue one send, returns False if the tick is skipped"""
+        if user_id in self.pending or user_id in self.running:
+            self.counters['busy'] += 1
+            logger.warning(f"Previous send still running for user {user_id}, tick skipped")
+            return False
+        
+        try:
+            self.queue.put_nowait((user_id, due))
+        except asyncio.QueueFull:
+            # Next tick of this user is already on the heap, so dropping is safe
+            self.counters['full'] += 1
+            logger.warning(f"Send queue full, tick of user {user_id} dropped")
+            return False
+        
+        self.pending.add(user_id)
+        self.start()
+        return True
+    
+    async def worker(self):
+        while True:
+            user_id, due = await self.queue.get()
+            self.pending.discard(user_id)
+            try:
+                lag = time.time() - due
+                if lag > self.max_lag:
+                    self.counters['overdue'] += 1
+                    logger.warning(f"Tick of user {user_id} is {lag:.0f}s late, dropped")
+                    continue
+                
+                self.counters['lag_max'] = max(self.counters['lag_max'], lag)
+                self.running[user_id] = asyncio.current_task()
+                await self.handler(user_id)
+                self.counters['done'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Send worker error for user {user_id}: {e}")
+            finally:
+                self.running.pop(user_id, None)
+                self.queue.task_done()
+    
+    def stop(self):
+        for task in self.tasks:
+            if not task.done():
+                task.cancel()
+        self.tasks = []
+    
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'busy_workers': len(self.running),
+            'queued': self.queue.qsize(),
+            'max_queue': self.queue.maxsize,
+            **self.counters,
+        }
@@ -0,0 +1,403 @@
+"""Sender worker processes and their coordinator
+
+The bot process keeps the UI and forwards sender commands to the worker
+that owns the account. Workers talk JSON lines over stdin/stdout:
+
+    request:  {"id": 1, "cmd": "start_sender", "args": {"user_id": 42}}
+    response: {"id": 1, "result": null} or {"id": 1, "error": "..."}
+    event:    {"event": "changed", "user_ids": [42]}
+
+Requests without an id get no response. Run a worker by hand with
+    python shard.py <index> <count>
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+from config import METRICS_PORT
+from db import Database, AsyncDatabase
+from metrics import registry
+from mtproto import MTProtoManager
+from scheduler import Scheduler, shard_of
+
+logger = logging.getLogger(__name__)
+
+# One line may carry the ids of every user of a shard
+LINE_LIMIT = 2**24
+RESTART_DELAY = 5
+CALL_TIMEOUT = 60
+
+# Averages and maximums can not be summed over shards
+MAX_KEYS = {'wait_avg', 'wait_max', 'lag_max'}
+
+def merge_stats(items):
+    """Add up numbers of several status dicts key by key"""
+    merged = {}
+    for item in items:
+        for key, value in item.items():
+            if isinstance(value, dict):
+                merged[key] = merge_stats([merged.get(key, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                if key in MAX_KEYS:
+                    merged[key] = max(merged.get(key, 0), value)
+                else:
+                    merged[key] = merged.get(key, 0) + value
+    return merged
+
+def encode(message):
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode()
+
+class ShardWorker:
+    """Scheduler and client pool of one shard, driven by the coordinator"""
+    
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.db = AsyncDatabase(Database(shard=(index, count)))
+        self.mtproto_mgr = MTProtoManager(self.db)
+        self.scheduler = Scheduler(None, self.db, self.mtproto_mgr, shard=(index, count))
+        self.stopping = asyncio.Event()
+        self.changed = set()
+    
+    def emit(self, message):
+        sys.stdout.buffer.write(encode(message))
+        sys.stdout.buffer.flush()
+    
+    def on_records(self, user_ids):
+        """Collect users changed by this shard, one event per loop turn"""
+        if not self.changed:
+            asyncio.get_running_loop().call_soon(self.emit_changed)
+        self.changed |= user_ids
+    
+    def emit_changed(self):
+        user_ids, self.changed = sorted(self.changed), set()
+        self.emit({'event': 'changed', 'user_ids': user_ids})
+    
+    async def cmd_start_sender(self, user_id):
+        await self.scheduler.start_sender(user_id)
+    
+    async def cmd_stop_sender(self, user_id):
+        await self.scheduler.stop_sender(user_id)
+    
+    async def cmd_start_many(self, user_ids):
+        outcomes = await self.scheduler.start_many(user_ids)
+        return list(outcomes.items())
+    
+    async def cmd_unschedule_all(self):
+        user_ids = list(self.scheduler.entries)
+        for user_id in user_ids:
+            self.scheduler.unschedule(user_id)
+        return user_ids
+    
+    async def cmd_reload(self, user_ids):
+        old = {user_id: self.db.db.records.get(user_id) for user_id in user_ids}
+        records = await self.db.reload_records(user_ids)
+        for user_id, record in zip(user_ids, records):
+            if old[user_id] and (record is None or record.session_string != old[user_id].session_string):
+                # Account logged in again or deleted, the pooled client is stale
+                await self.mtproto_mgr.delete_session(user_id)
+    
+    async def cmd_settings(self):
+        await self.db.load_settings()
+    
+    async def cmd_forget(self, user_id):
+        await self.mtproto_mgr.delete_session(user_id)
+        await self.scheduler.forget_user(user_id)
+    
+    async def cmd_status(self):
+        return await self.scheduler.status()
+    
+    async def cmd_stats(self):
+        return registry.snapshot()
+    
+    async def cmd_shutdown(self):
+        self.stopping.set()
+    
+    async def handle(self, message):
+        try:
+            handler = getattr(self, f"cmd_{message['cmd']}")
+            result = await handler(**message.get('args', {}))
+            reply = {'result': result}
+        except Exception as e:
+            logger.error(f"Shard {self.index} command {message.get('cmd')} error: {e}")
+            reply = {'error': f"{type(e).__name__}: {e}"}
+        if 'id' in message:
+            self.emit({'id': message['id'], **reply})
+    
+    async def read_commands(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=LINE_LIMIT)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        
+        while not self.stopping.is_set():
+            line = await reader.readline()
+            if not line:
+                # Coordinator is gone
+                break
+            # Run in order, a reload must be applied before later commands
+            await self.handle(json.loads(line))
+        self.stopping.set()
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.db.subscribe(lambda key, value, version: loop.call_soon_threadsafe(self.mtproto_mgr.on_setting, key, value))
+        self.db.subscribe_records(lambda user_ids: loop.call_soon_threadsafe(self.on_records, user_ids))
+        
+        self.scheduler.register_metrics()
+        if METRICS_PORT:
+            await registry.serve(METRICS_PORT + 1 + self.index)
+        
+        self.mtproto_mgr.start_reaper()
+        await self.scheduler.restore_senders()
+        logger.info(f"Shard {self.index}/{self.count} ready, {len(self.scheduler.entries)} senders")
+        
+        try:
+            await self.read_commands()
+        finally:
+            registry.close()
+            await self.scheduler.close()
+            await self.mtproto_mgr.disconnect_all()
+            self.db.close()
+            logger.info(f"Shard {self.index} stopped")
+
+class ShardProcess:
+    """Coordinator side of one worker process"""
+    
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.proc = None
+        self.calls = {}
+        self.seq = 0
+        self.restarts = 0
+    
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+    
+    async def spawn(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), str(self.index), str(self.count),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=LINE_LIMIT
+        )
+        logger.info(f"Shard {self.index} started, pid {self.proc.pid}")
+    
+    def send(self, cmd, **args):
+        """Command without waiting for its result"""
+        if not self.alive:
+            logger.warning(f"Shard {self.index} is down, {cmd} dropped")
+            return
+        self.proc.stdin.write(encode({'cmd': cmd, 'args': args}))
+    
+    async def call(self, cmd, **args):
+        if not self.alive:
+            raise RuntimeError(f"Shard {self.index} is down")
+        self.seq += 1
+        seq = self.seq
+        future = asyncio.get_running_loop().create_future()
+        self.calls[seq] = future
+        try:
+            self.proc.stdin.write(encode({'id': seq, 'cmd': cmd, 'args': args}))
+            await self.proc.stdin.drain()
+            return await asyncio.wait_for(future, CALL_TIMEOUT)
+        finally:
+            self.calls.pop(seq, None)
+    
+    def fail_calls(self):
+        for future in self.calls.values():
+            if not future.done():
+                future.set_exception(RuntimeError(f"Shard {self.index} exited"))
+        self.calls.clear()
+    
+    async def kill(self):
+        """Make sure the worker is gone before another one takes its accounts"""
+        if self.proc is None:
+            return
+        if self.proc.returncode is None:
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass
+        await self.proc.wait()
+
+class ShardCoordinator:
+    """Scheduler API of the bot process, every account lives in one worker"""
+    
+    def __init__(self, db, mtproto_mgr, count):
+        self.db = db
+        self.mtproto_mgr = mtproto_mgr
+        self.count = count
+        self.shards = [ShardProcess(index, count) for index in range(count)]
+        self.readers = []
+        self.changed = set()
+        self.closing = False
+    
+    def owner(self, user_id):
+        return self.shards[shard_of(user_id, self.count)]
+    
+    async def read_shard(self, shard):
+        """Deliver replies and events of a worker, restart it when it exits"""
+        while not self.closing:
+            try:
+                await shard.spawn()
+                while True:
+                    line = await shard.proc.stdout.readline()
+                    if not line:
+                        break
+                    try:
+                        await self.handle_line(shard, line)
+                    except Exception as e:
+                        # One bad message must not cost the pipe and restart the worker
+                        logger.error(f"Shard {shard.index} message {line[:200]!r} error: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Shard {shard.index} reader error: {e}")
+            
+            shard.fail_calls()
+            if self.closing:
+                return
+            # A second worker for the same accounts would post every advert twice
+            await shard.kill()
+            shard.restarts += 1
+            logger.error(f"Shard {shard.index} exited with {shard.proc.returncode if shard.proc else None}, restarting")
+            await asyncio.sleep(RESTART_DELAY)
+    
+    async def handle_line(self, shard, line):
+        message = json.loads(line)
+        if 'event' in message:
+            # Applied before the reply that follows, so the UI sees fresh state
+            await self.db.reload_records(message['user_ids'])
+            return
+        future = shard.calls.get(message.get('id'))
+        if future and not future.done():
+            if 'error' in message:
+                future.set_exception(RuntimeError(message['error']))
+            else:
+                future.set_result(message.get('result'))
+    
+    def on_records(self, user_ids):
+        """Users changed by the bot, the owning workers must reload them"""
+        if not self.changed:
+            asyncio.get_running_loop().call_soon(self.send_changed)
+        self.changed |= user_ids
+    
+    def send_changed(self):
+        user_ids, self.changed = self.changed, set()
+        by_shard = {}
+        for user_id in user_ids:
+            by_shard.setdefault(self.owner(user_id), []).append(user_id)
+        for shard, ids in by_shard.items():
+            shard.send('reload', user_ids=ids)
+    
+    def on_setting(self, key, value):
+        for shard in self.shards:
+            shard.send('settings')
+    
+    async def restore_senders(self):
+        """Start workers, each restores its own active senders"""
+        loop = asyncio.get_running_loop()
+        self.db.subscribe(lambda key, value, version: loop.call_soon_threadsafe(self.on_setting, key, value))
+        self.db.subscribe_records(lambda user_ids: loop.call_soon_threadsafe(self.on_records, user_ids))
+        self.readers = [asyncio.create_task(self.read_shard(shard)) for shard in self.shards]
+    
+    async def start_sender(self, user_id):
+        await self.owner(user_id).call('start_sender', user_id=user_id)
+    
+    async def stop_sender(self, user_id):
+        await self.owner(user_id).call('stop_sender', user_id=user_id)
+    
+    async def start_many(self, user_ids):
+        by_shard = {}
+        for user_id in user_ids:
+            by_shard.setdefault(self.owner(user_id), []).append(user_id)
+        results = await asyncio.gather(
+            *(shard.call('start_many', user_ids=ids) for shard, ids in by_shard.items()),
+            return_exceptions=True
+        )
+        outcomes = {}
+        for (shard, ids), result in zip(by_shard.items(), results):
+            if isinstance(result, Exception):
+                logger.error(f"Bulk start on shard {shard.index} failed: {result}")
+                outcomes.update((user_id, 'shard_down') for user_id in ids)
+            else:
+                outcomes.update((user_id, outcome) for user_id, outcome in result)
+        return outcomes
+    
+    async def stop_all(self):
+        user_ids = await self.db.deactivate_all()
+        outcomes = {user_id: 'stopped' for user_id in user_ids}
+        results = await asyncio.gather(
+            *(shard.call('unschedule_all') for shard in self.shards), return_exceptions=True
+        )
+        for result in results:
+            if not isinstance(result, Exception):
+                for user_id in result:
+                    outcomes.setdefault(user_id, 'stopped')
+        logger.info(f"Bulk stop: {len(outcomes)} senders stopped on {self.count} shards")
+        return outcomes
+    
+    async def adopt(self, user_id, client):
+        """Worker connects with the saved session itself, login client is not needed"""
+        await client.disconnect()
+    
+    async def forget_user(self, user_id):
+        await self.owner(user_id).call('forget', user_id=user_id)
+    
+    async def last_success(self, user_id):
+        return await self.db.get_last_success(user_id)
+    
+    def recent_success(self, user_id):
+        return None
+    
+    async def is_active(self, user_id):
+        return await self.db.is_sending_active(user_id)
+    
+    async def get_active_count(self):
+        return (await self.db.get_counts())['active']
+    
+    async def status(self):
+        """Status of all workers added up"""
+        results = await asyncio.gather(
+            *(shard.call('status') for shard in self.shards if shard.alive), return_exceptions=True
+        )
+        status = merge_stats([r for r in results if not isinstance(r, Exception)])
+        status['shards'] = {
+            'alive': sum(1 for shard in self.shards if shard.alive),
+            'total': self.count,
+            'restarts': sum(shard.restarts for shard in self.shards),
+        }
+        return status
+    
+    async def metric_snapshots(self):
+        """Registry snapshots of all live workers"""
+        results = await asyncio.gather(
+            *(shard.call('stats') for shard in self.shards if shard.alive), return_exceptions=True
+        )
+        return [r for r in results if not isinstance(r, Exception)]
+    
+    def register_metrics(self):
+        registry.gauge('shards_alive', lambda: sum(1 for shard in self.shards if shard.alive))
+        registry.gauge('shard_calls_pending', lambda: sum(len(shard.calls) for shard in self.shards))
+    
+    async def close(self):
+        """Ask workers to finish their sends and exit"""
+        self.closing = True
+        for shard in self.shards:
+            shard.send('shutdown')
+        for shard in self.shards:
+            if shard.proc is None:
+                continue
+            try:
+                await asyncio.wait_for(shard.proc.wait(), 30)
+            except asyncio.TimeoutError:
+                logger.error(f"Shard {shard.index} did not stop, killing it")
+                shard.proc.kill()
+        for task in self.readers:
+            task.cancel()
+
+if __name__ == '__main__':
+    # stdout carries the protocol, logs go to stderr
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - shard - %(levelname)s - %(message)s')
+    asyncio.run(ShardWorker(int(sys.argv[1]), int(sys.argv[2])).run())
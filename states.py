@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from config import LOGIN_TTL, MAX_PENDING_LOGINS
+
+logger = logging.getLogger(__name__)
+
+class LoginStates:
+    """Per-user dialog state with expiry and cleanup of login clients"""
+    
+    def __init__(self, ttl=LOGIN_TTL, max_size=MAX_PENDING_LOGINS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.states = {}
+        self.expires = {}
+        self.counters = {'expired': 0, 'rejected': 0, 'peak': 0}
+        self.sweeper = None
+    
+    def __contains__(self, user_id):
+        if user_id not in self.states:
+            return False
+        if self.expires[user_id] < time.monotonic():
+            self.expire(user_id)
+            return False
+        return True
+    
+    def __getitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        self.expires[user_id] = time.monotonic() + self.ttl
+        return self.states[user_id]
+    
+    def __setitem__(self, user_id, state):
+        old = self.states.get(user_id)
+        if old and old.get('client') is not state.get('client'):
+            self.drop_client(user_id, old)
+        self.states[user_id] = state
+        self.expires[user_id] = time.monotonic() + self.ttl
+        self.counters['peak'] = max(self.counters['peak'], len(self.states))
+    
+    def __delitem__(self, user_id):
+        del self.states[user_id]
+        del self.expires[user_id]
+    
+    def __len__(self):
+        return len(self.states)
+    
+    def is_full(self, user_id=None):
+        """Check if a new login can not be started now"""
+        if user_id in self.states:
+            return False
+        if len(self.states) >= self.max_size:
+            self.sweep()
+        if len(self.states) >= self.max_size:
+            self.counters['rejected'] += 1
+            return True
+        return False
+    
+    def discard(self, user_id):
+        """Remove state and disconnect its login client"""
+        state = self.states.pop(user_id, None)
+        self.expires.pop(user_id, None)
+        if state:
+            self.drop_client(user_id, state)
+    
+    def expire(self, user_id):
+        self.counters['expired'] += 1
+        logger.info(f"Login state expired for user {user_id}")
+        self.discard(user_id)
+    
+    def drop_client(self, user_id, state):
+        """Disconnect abandoned login client in background"""
+        client = state.get('client')
+        if client is None:
+            return
+        
+        async def disconnect():
+            try:
+                await client.disconnect()
+            except Exception as e:
+                logger.error(f"Login client disconnect error for user {user_id}: {e}")
+        
+        asyncio.ensure_future(disconnect())
+    
+    def sweep(self):
+        """Drop all expired states"""
+        now = time.monotonic()
+        for user_id in [u for u, t in self.expires.items() if t < now]:
+            self.expire(user_id)
+    
+    async def sweeper_loop(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 60))
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Login state sweeper error: {e}")
+    
+    def start_sweeper(self):
+        if self.sweeper is None or self.sweeper.done():
+            self.sweeper = asyncio.create_task(self.sweeper_loop())
+    
+    def stats(self):
+        return {
+            'size': len(self.states),
+            'clients': sum(1 for s in self.states.values() if s.get('client')),
+            **self.counters,
+        }
@@ -0,0 +1,21 @@
+from telethon.tl import types
+from formatting import parse_text, clean_entities, dump_entities, load_entities
+
+def test_parse_text_drops_user_mentions():
+    text, entities = parse_text('[Ali](tg://user?id=123) **yo\'l** [sayt](https://x.uz)', 'md')
+    assert text == "Ali yo'l sayt"
+    assert [type(e) for e in entities] == [types.MessageEntityBold, types.MessageEntityTextUrl]
+
+def test_clean_entities_drops_empty_and_mention_entities():
+    bold = types.MessageEntityBold(0, 2)
+    entities = [
+        types.MessageEntityBold(1, 0),
+        types.MessageEntityMentionName(0, 3, 42),
+        types.MessageEntityTextUrl(0, 3, 'tg://user?id=42'),
+        bold,
+    ]
+    assert clean_entities(entities) == [bold]
+
+def test_stored_entities_are_cleaned_on_load():
+    stored = dump_entities([types.MessageEntityMentionName(0, 3, 42), types.MessageEntityItalic(0, 3)])
+    assert [type(e) for e in load_entities(stored)] == [types.MessageEntityItalic]
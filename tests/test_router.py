@@ -0,0 +1,46 @@
+import asyncio
+from router import CallbackRouter
+
+class FakeEvent:
+    def __init__(self, data):
+        self.data = data
+        self.sender_id = 1
+        self.answered = False
+    
+    async def answer(self, *args, **kwargs):
+        self.answered = True
+
+def dispatch(router, data):
+    event = FakeEvent(data)
+    asyncio.run(router.dispatch(event))
+    return event
+
+def make_router(calls):
+    async def profile(event):
+        calls.append(('profile',))
+    
+    async def users(event, cursor=''):
+        calls.append(('users', cursor))
+    
+    async def target_del(event, chat_id):
+        calls.append(('target_del', chat_id))
+    
+    router = CallbackRouter()
+    router.add(b"profile", profile)
+    router.add(b"admin_users", users, arg=r'[<>]\d+')
+    router.add(b"target_del", target_del, arg=r'-?\d+')
+    return router
+
+def test_valid_callbacks_reach_their_handlers():
+    calls = []
+    router = make_router(calls)
+    for data in (b"profile", b"admin_users", b"admin_users:>42", b"target_del:-100123"):
+        assert not dispatch(router, data).answered
+    assert calls == [('profile',), ('users', ''), ('users', '>42'), ('target_del', '-100123')]
+
+def test_malformed_callbacks_are_answered_not_raised():
+    calls = []
+    router = make_router(calls)
+    for data in (b"profile:x", b"admin_users:>abc", b"target_del", b"target_del:1; x", b"target_del:\xff", b"nope"):
+        assert dispatch(router, data).answered
+    assert calls == []
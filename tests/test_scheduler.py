@@ -0,0 +1,82 @@
+import asyncio
+import time
+import scheduler as scheduler_module
+from ratelimit import TargetLimiter
+from scheduler import Scheduler, next_slot, phase_offset
+
+class FakeDatabase:
+    async def set_sending_active(self, user_id, is_active):
+        pass
+    
+    async def get_record(self, user_id):
+        return None
+
+class FakeSendLog:
+    async def last_success(self, user_id):
+        return None
+
+def test_next_slot_is_on_users_phase():
+    interval = 10
+    phase = phase_offset(42, interval)
+    for after in (0, 3.3, 99.99, 1e9 + 0.5):
+        slot = next_slot(42, interval, after)
+        assert after <= slot < after + interval
+        assert abs((slot - phase) / interval - round((slot - phase) / interval)) < 1e-6
+
+def test_next_slot_keeps_exact_slot():
+    slot = next_slot(7, 10, 1000)
+    assert next_slot(7, 10, slot) == slot
+
+def test_start_sends_now_and_then_joins_next_phase_slot():
+    async def run():
+        scheduler = Scheduler(None, FakeDatabase(), None)
+        scheduler.interval = 10
+        scheduler.send_log = FakeSendLog()
+        
+        now = time.time()
+        await scheduler.start_sender(42)
+        entry = scheduler.entries[42]
+        assert abs(entry.due - now) < 1
+        
+        # What the dispatcher does after firing the immediate send
+        entry.slot += scheduler.interval * entry.pace
+        expected = next_slot(42, 10, now + 5)
+        assert abs(entry.slot - expected) < 1e-6
+        assert entry.slot - now < 1.5 * scheduler.interval
+        scheduler.stop()
+    
+    asyncio.run(run())
+
+def test_pace_decay_updates_running_entry():
+    async def run():
+        scheduler = Scheduler(None, FakeDatabase(), None)
+        scheduler.interval = 10
+        now = time.time()
+        scheduler.schedule(42, next_slot(42, 40, now + 20), pace=4.0)
+        scheduler.entries[42].last = now
+        
+        scheduler.set_pace(42, 3.6)
+        entry = scheduler.entries[42]
+        assert entry.pace == 3.6
+        assert entry.last == now
+        assert entry.slot == next_slot(42, 36, now + 18)
+        assert len([e for _, _, e in scheduler.heap if not e.cancelled]) == 1
+        scheduler.stop()
+    
+    asyncio.run(run())
+
+def test_targets_waiting_too_long_for_tokens_are_skipped(monkeypatch):
+    monkeypatch.setattr(scheduler_module, 'SEND_MAX_LAG', 0.05)
+    
+    async def run():
+        scheduler = Scheduler(None, FakeDatabase(), None)
+        scheduler.limiter = TargetLimiter(rate=1, burst=1)
+        await scheduler.limiter.acquire(-100)
+        
+        ready = await scheduler.acquire_targets(42, [-100, -200])
+        assert ready == [-200]
+        assert scheduler.limiter.buckets[-100].queued == 0
+        assert [row[3] for row in scheduler.send_log.buffer] == ['throttled']
+        scheduler.stop()
+    
+    asyncio.run(run())
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import shard
+from shard import ShardCoordinator, ShardProcess, merge_stats
+from db import shard_of
+
+class FakeStdout:
+    def __init__(self, lines):
+        self.lines = list(lines)
+    
+    async def readline(self):
+        await asyncio.sleep(0)
+        return self.lines.pop(0) if self.lines else b''
+
+class FakeProc:
+    """Worker that closed its stdout but is still running"""
+    
+    def __init__(self, lines):
+        self.stdout = FakeStdout(lines)
+        self.returncode = None
+        self.killed = False
+    
+    def kill(self):
+        self.killed = True
+        self.returncode = -9
+    
+    async def wait(self):
+        return self.returncode
+
+class FakeShard:
+    """ShardProcess stand-in recording the calls routed to it"""
+    
+    def __init__(self, index, fail=False):
+        self.index = index
+        self.fail = fail
+        self.calls = []
+        self.alive = True
+    
+    async def call(self, cmd, **args):
+        self.calls.append((cmd, args))
+        if self.fail:
+            raise RuntimeError(f"Shard {self.index} is down")
+        if cmd == 'start_many':
+            return [[user_id, 'started'] for user_id in args['user_ids']]
+
+class FailingDatabase:
+    def __init__(self):
+        self.reloads = []
+    
+    async def reload_records(self, user_ids):
+        self.reloads.append(user_ids)
+        raise RuntimeError("database is locked")
+
+def test_merge_stats_adds_numbers_and_keeps_maximums():
+    merged = merge_stats([
+        {'senders': 2, 'pool': {'live': 3, 'wait_max': 1.5}, 'busy': True},
+        {'senders': 5, 'pool': {'live': 4, 'wait_max': 0.5}, 'name': 'x'},
+    ])
+    assert merged == {'senders': 7, 'pool': {'live': 7, 'wait_max': 1.5}}
+
+def test_coordinator_routes_users_to_their_shard():
+    async def run():
+        coordinator = ShardCoordinator(None, None, 3)
+        coordinator.shards = [FakeShard(i) for i in range(3)]
+        for user_id in range(1, 20):
+            await coordinator.start_sender(user_id)
+        for index, fake in enumerate(coordinator.shards):
+            assert fake.calls
+            assert all(shard_of(args['user_id'], 3) == index for _, args in fake.calls)
+    
+    asyncio.run(run())
+
+def test_start_many_reports_users_of_a_down_shard():
+    async def run():
+        coordinator = ShardCoordinator(None, None, 2)
+        coordinator.shards = [FakeShard(0), FakeShard(1, fail=True)]
+        user_ids = list(range(1, 11))
+        outcomes = await coordinator.start_many(user_ids)
+        assert set(outcomes) == set(user_ids)
+        for user_id in user_ids:
+            expected = 'shard_down' if shard_of(user_id, 2) == 1 else 'started'
+            assert outcomes[user_id] == expected
+    
+    asyncio.run(run())
+
+def test_reader_survives_bad_lines_and_kills_worker_before_restart(monkeypatch):
+    monkeypatch.setattr(shard, 'RESTART_DELAY', 0)
+    
+    async def run():
+        db = FailingDatabase()
+        coordinator = ShardCoordinator(db, None, 1)
+        process = coordinator.shards[0]
+        procs = []
+        
+        async def spawn():
+            if procs:
+                # Second start: the old worker must be gone by now
+                assert procs[-1].killed
+                coordinator.closing = True
+            reply = json.dumps({'id': 1, 'result': 'ok'}).encode() + b'\n'
+            procs.append(FakeProc([
+                b'not json\n',
+                b'{"result": null}\n',
+                b'{"event": "changed", "user_ids": [42]}\n',
+                reply,
+            ]))
+            process.proc = procs[-1]
+        
+        process.spawn = spawn
+        future = asyncio.get_running_loop().create_future()
+        process.calls[1] = future
+        await coordinator.read_shard(process)
+        
+        # Reply after the bad lines still reached its caller
+        assert future.result() == 'ok'
+        assert db.reloads == [[42], [42]]
+        assert len(procs) == 2 and process.restarts == 1
+    
+    asyncio.run(run())
+
+def test_kill_waits_for_running_worker():
+    async def run():
+        process = ShardProcess(0, 1)
+        await process.kill()
+        process.proc = FakeProc([])
+        await process.kill()
+        assert process.proc.killed
+    
+    asyncio.run(run())